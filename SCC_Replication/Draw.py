@@ -1,63 +1,95 @@
 import torch
 from Steps import *
+import Utils.ComputingUtils as ComputingUtils
+import Utils.FileUtils as FileUtils
 import Variables.PreComputed as PreComputed
 import Variables.Store as Store
 import Variables.State as State
+import Variables.Residuals as Residuals
+import Variables.Summaries as Summaries
+import Forecast
+
+state_names = [
+    "p_c_kappa", "p_g_kappa", "p_h_kappa",
+    "p_c_theta", "p_g_theta", "p_h_theta",
+    "p_c_lambda", "p_g_lambda",
+    "F", "S_m", "X", "C", "Y0",
+    "sigma_m2", "sigma_Da2", "ind_rho", "mu_c", "omega2", "f0", "mu_m",
+    "kappa_c2", "kappa_g2", "kappa_h2",
+    "lambda_c", "lambda_g",
+    "G", "H", "K", "J",
+    "ind_theta_c", "ind_theta_g", "ind_theta_h"
+]
 
 def initialize(regions: list[Region],
                no_kappas: int=25,
                no_lambdas: int=25,
-               no_thetas: int=100):
-    State.p_c_kappa = torch.ones(no_kappas).to(PreComputed.device)/no_kappas
-    State.p_g_kappa = torch.ones(no_kappas).to(PreComputed.device)/no_kappas
-    State.p_h_kappa = torch.ones(no_kappas).to(PreComputed.device)/no_kappas
-
-    State.p_c_theta = torch.ones(no_thetas).to(PreComputed.device)/no_thetas
-    State.p_g_theta = torch.ones(no_thetas).to(PreComputed.device)/no_thetas
-    State.p_h_theta = torch.ones(no_thetas).to(PreComputed.device)/no_thetas
-
-    State.p_c_lambda = torch.ones(no_lambdas).to(PreComputed.device)/no_lambdas
-    State.p_g_lambda = torch.ones(no_lambdas).to(PreComputed.device)/no_lambdas
-
-    State.F = torch.zeros(q+1).to(PreComputed.device)
-    State.S_m = torch.zeros(q+1).to(PreComputed.device)
-    State.X = torch.zeros((n, q+1)).to(PreComputed.device)
-    State.C = torch.zeros((n, q+1)).to(PreComputed.device)
+               no_thetas: int=100,
+               n_chains: int=1,
+               seeds: list[int]=None):
+    if seeds is None:
+        seeds = torch.randint(0, 2**62, (n_chains,)).tolist()
+    State.n_chains = n_chains
+    State.generators = ComputingUtils.chain_generators(seeds)
+    Forecast.seed_generators(seeds)
+    ComputingUtils.reset_buffers()
+
+    State.p_c_kappa = torch.ones((n_chains, no_kappas)).to(PreComputed.device)/no_kappas
+    State.p_g_kappa = torch.ones((n_chains, no_kappas)).to(PreComputed.device)/no_kappas
+    State.p_h_kappa = torch.ones((n_chains, no_kappas)).to(PreComputed.device)/no_kappas
+
+    State.p_c_theta = torch.ones((n_chains, no_thetas)).to(PreComputed.device)/no_thetas
+    State.p_g_theta = torch.ones((n_chains, no_thetas)).to(PreComputed.device)/no_thetas
+    State.p_h_theta = torch.ones((n_chains, no_thetas)).to(PreComputed.device)/no_thetas
+
+    State.p_c_lambda = torch.ones((n_chains, no_lambdas)).to(PreComputed.device)/no_lambdas
+    State.p_g_lambda = torch.ones((n_chains, no_lambdas)).to(PreComputed.device)/no_lambdas
+
+    State.F = torch.zeros((n_chains, q+1)).to(PreComputed.device)
+    State.S_m = torch.zeros((n_chains, q+1)).to(PreComputed.device)
+    X = torch.zeros((n, q+1)).to(PreComputed.device)
     for i, r in enumerate(regions):
-        State.X[i] = torch.matmul(r.AApAi, r.Y)
-        State.C[i] = State.X[i]-State.F
+        X[i] = torch.matmul(r.AApAi, r.Y)
+    State.X = X.repeat(n_chains, 1, 1)
+    State.C = State.X-State.F.unsqueeze(1)
     State.Y0 = torch.zeros(q+1).to(PreComputed.device)
 
-    State.sigma_m2 = PreComputed.sigma_grid[0]
-    State.sigma_Da2 = 0.03**2/2.198
-    State.ind_rho = 0
-    State.mu_c = 0
-    State.omega2 = 1
-    State.kappa_c2 = torch.ones(n).to(PreComputed.device)
-    State.kappa_g2 = torch.ones(25).to(PreComputed.device)
-    State.kappa_h2 = torch.ones(10).to(PreComputed.device)
-    State.lambda_c = torch.zeros(n).to(PreComputed.device)
-    State.lambda_g = torch.zeros(25).to(PreComputed.device)
-    State.ind_theta_c = torch.zeros(n).int().to(PreComputed.device)
-    State.ind_theta_g = torch.zeros(25).int().to(PreComputed.device)
-    State.ind_theta_h = torch.zeros(10).int().to(PreComputed.device)
-    State.G = torch.zeros((25,q+1)).to(PreComputed.device)
-    State.H = torch.zeros((10, q+1)).to(PreComputed.device)
-    State.K = torch.zeros(25).int().to(PreComputed.device)
-    State.J = torch.zeros(n).int().to(PreComputed.device)
-    for i in range(25):
-        State.ind_theta_g[i] = int(i%100)
-        State.K[i] = int(i%10)
-    for i in range(n):
-        State.J[i] = int(i%25)
-        State.ind_theta_c[i] = State.ind_theta_g[State.J[i]]
-    for i in range(10):
-        State.ind_theta_h[i] = int(i%100)
+    ones = torch.ones(n_chains).to(PreComputed.device)
+    State.sigma_m2 = PreComputed.sigma_grid[0]*ones
+    State.sigma_Da2 = 0.03**2/2.198*ones
+    State.ind_rho = torch.zeros(n_chains).long().to(PreComputed.device)
+    State.mu_c = 0*ones
+    State.omega2 = ones.clone()
+    State.f0 = State.f0*ones
+    State.mu_m = State.mu_m*ones
+    no_groups = PreComputed.no_groups
+    no_supergroups = PreComputed.no_supergroups
+    State.kappa_c2 = torch.ones((n_chains, n)).to(PreComputed.device)
+    State.kappa_g2 = torch.ones((n_chains, no_groups)).to(PreComputed.device)
+    State.kappa_h2 = torch.ones((n_chains, no_supergroups)).to(PreComputed.device)
+    State.lambda_c = torch.zeros((n_chains, n)).to(PreComputed.device)
+    State.lambda_g = torch.zeros((n_chains, no_groups)).to(PreComputed.device)
+    State.G = torch.zeros((n_chains, no_groups, q+1)).to(PreComputed.device)
+    State.H = torch.zeros((n_chains, no_supergroups, q+1)).to(PreComputed.device)
+    ind_theta_g = torch.arange(no_groups).to(PreComputed.device)%no_thetas
+    K = torch.arange(no_groups).to(PreComputed.device)%no_supergroups
+    J = torch.arange(n).to(PreComputed.device)%no_groups
+    State.ind_theta_g = ind_theta_g.repeat(n_chains, 1)
+    State.K = K.repeat(n_chains, 1)
+    State.J = J.repeat(n_chains, 1)
+    State.ind_theta_c = ind_theta_g[J].repeat(n_chains, 1)
+    State.ind_theta_h = (torch.arange(no_supergroups).to(PreComputed.device)%no_thetas).repeat(n_chains, 1)
+    Residuals.reset()
+    Summaries.reset()
+    Forecast.reset()
 
 def draw():
-    step1(PreComputed.Chol_Sigma_U, 
-          PreComputed.SuAA,
-          PreComputed.SuAAS,
+    step1(PreComputed.Sigma_U,
+          PreComputed.Chol_Sigma_U, 
+          PreComputed.SuA,
+          PreComputed.A,
+          PreComputed.ASA,
+          PreComputed.region_pattern,
           PreComputed.weights,
           PreComputed.Delta)
 
@@ -85,9 +117,9 @@ def draw():
 
     step13(PreComputed.kappa_grid)
 
-    step14(PreComputed.Sigma_U_inv)
+    step14(PreComputed.Chol_Sigma_U)
 
-    step15(PreComputed.Sigma_U_inv)
+    step15(PreComputed.Chol_Sigma_U)
 
     step16(PreComputed.Sigma_U_inv, PreComputed.Det_Sigma_U)
 
@@ -130,54 +162,86 @@ def draw():
     )
 
 def store_draw():
-    Store.p_c_kappa_draws.append(State.p_c_kappa)
-    Store.p_g_kappa_draws.append(State.p_g_kappa)
-    Store.p_h_kappa_draws.append(State.p_h_kappa)
-
-    Store.p_c_theta_draws.append(State.p_c_theta)
-    Store.p_g_theta_draws.append(State.p_g_theta)
-    Store.p_h_theta_draws.append(State.p_h_theta)
-
-    Store.p_c_lambda_draws.append(State.p_c_lambda)
-    Store.p_g_lambda_draws.append(State.p_g_lambda)
-
-    Store.F_draws.append(State.F)
-    Store.S_m_draws.append(State.S_m)
-    Store.X_draws.append(State.X)
-    Store.C_draws.append(State.C)
-
-    Store.sigma_m2_draws.append(State.sigma_m2)
-    Store.sigma_Da2_draws.append(State.sigma_Da2)
-    Store.ind_rho_draws.append(State.ind_rho)
-    Store.mu_c_draws.append(State.mu_c)
-    Store.omega2_draws.append(State.omega2)
-    Store.f0_draws.append(State.f0)
-    Store.mu_m_draws.append(State.mu_m)
-
-    Store.kappa_c2_draws.append(State.kappa_c2)
-    Store.kappa_g2_draws.append(State.kappa_g2)
-    Store.kappa_h2_draws.append(State.kappa_h2)
-
-    Store.lambda_c_draws.append(State.lambda_c)
-    Store.lambda_g_draws.append(State.lambda_g)
-
-    Store.G_draws.append(State.G)
-    Store.H_draws.append(State.H)
-    Store.K_draws.append(State.K)
-    Store.J_draws.append(State.J)
-
-    Store.ind_theta_c_draws.append(State.ind_theta_c)
-    Store.ind_theta_g_draws.append(State.ind_theta_g)
-    Store.ind_theta_h_draws.append(State.ind_theta_h)
-
-def sample(burn_in: int, total_draws: int, skips: int = 1):
-    Delta = PreComputed.Delta
-    for i in range(burn_in):
-        if i % 20 == 1:
-            PreComputed.Delta = Delta*1000**(max(0, (burn_in/2-i)/(0.5*burn_in)))
-            PreComputed.Deltainv = torch.linalg.inv(PreComputed.Delta)
-        draw()
-    for i in range(total_draws-burn_in):
-        draw()
-        if i % skips == 0:
-            store_draw()
\ No newline at end of file
+    Store.record({name+"_draws": getattr(State, name) for name in state_names})
+
+def save_checkpoint(path: str, sweep: int, Delta: torch.Tensor):
+    # Flushed first, so the stored draws on disk match the checkpointed sweep
+    Store.flush()
+    Forecast.flush()
+    FileUtils.write_torch({
+        "sweep": sweep,
+        "n_chains": State.n_chains,
+        "state": {name: getattr(State, name) for name in state_names},
+        "rng": [g.get_state() for g in State.generators],
+        "rng_buffers": ComputingUtils.buffers,
+        "rng_offsets": ComputingUtils.offsets,
+        "Delta_base": Delta,
+        "Delta": PreComputed.Delta,
+        "Deltainv": PreComputed.Deltainv,
+        "chain_ids": Store.chain_ids,
+        "segment": Store.segment,
+        "kept": Store.kept,
+        "summaries": Summaries.state(),
+        "paths_kept": Forecast.kept,
+        "paths_rng": [g.get_state() for g in Forecast.generators]
+    }, path)
+
+def load_checkpoint(path: str):
+    checkpoint = FileUtils.read_torch(path)
+    State.n_chains = checkpoint["n_chains"]
+    State.generators = ComputingUtils.chain_generators([0]*State.n_chains)
+    for g, rng in zip(State.generators, checkpoint["rng"]):
+        g.set_state(rng)
+    # Unused pre-drawn variates are handed out first, as in an uninterrupted run
+    for kind, block in checkpoint["rng_buffers"].items():
+        ComputingUtils.buffers[kind] = None if block is None else block.to(PreComputed.device)
+        ComputingUtils.offsets[kind] = checkpoint["rng_offsets"][kind]
+    for name, val in checkpoint["state"].items():
+        setattr(State, name, val.to(PreComputed.device))
+    PreComputed.Delta = checkpoint["Delta"].to(PreComputed.device)
+    PreComputed.Deltainv = checkpoint["Deltainv"].to(PreComputed.device)
+    Store.reset(checkpoint["chain_ids"])
+    Store.segment = checkpoint["segment"]
+    Store.kept = checkpoint["kept"]
+    # Draws stored after the checkpoint are drawn again
+    Store.truncate()
+    Residuals.reset()
+    Summaries.load_state(checkpoint["summaries"], PreComputed.device)
+    Forecast.reset()
+    Forecast.kept = checkpoint.get("paths_kept", 0)
+    # Checkpoints written before paths had their own generators are reseeded from the chain ids
+    Forecast.seed_generators(checkpoint["chain_ids"])
+    for g, rng in zip(Forecast.generators, checkpoint.get("paths_rng", [])):
+        g.set_state(rng)
+    return checkpoint["sweep"], checkpoint["Delta_base"].to(PreComputed.device)
+
+def sample(burn_in: int,
+           total_draws: int,
+           skips: int = 1,
+           start: int = 0,
+           Delta: torch.Tensor = None,
+           checkpoint_path: str = None,
+           checkpoint_every: int = 0):
+    if Delta is None:
+        Delta = PreComputed.Delta
+    for i in range(start, total_draws):
+        if i < burn_in:
+            if i % 20 == 1:
+                PreComputed.Delta = Delta*1000**(max(0, (burn_in/2-i)/(0.5*burn_in)))
+                PreComputed.Deltainv = torch.linalg.inv(PreComputed.Delta)
+            draw()
+        else:
+            draw()
+            if (i-burn_in) % skips == 0:
+                if Store.enabled:
+                    store_draw()
+                    if Store.buffered() >= Store.flush_every:
+                        Store.flush()
+                if Summaries.enabled:
+                    Summaries.update({name: getattr(State, name) for name in Summaries.names})
+                if Forecast.enabled:
+                    Forecast.record()
+                    if len(Forecast.buffer) >= Store.flush_every:
+                        Forecast.flush()
+        if checkpoint_path is not None and checkpoint_every > 0 and ((i+1) % checkpoint_every == 0 or i+1 == total_draws):
+            save_checkpoint(checkpoint_path, i+1, Delta)
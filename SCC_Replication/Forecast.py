@@ -0,0 +1,121 @@
+"""
+Posterior predictive paths drawn inside the sampler from every kept
+draw: the in-sample low-frequency fit followed by 100 forecast years,
+for F and for the country deviations C. Each chain's paths go to
+memory-mapped .npy arrays laid out as the baseline MSW output,
+path_F_draws (Tmax x draws) and paths_U_draws (Tmax x n x draws)
+"""
+
+import os
+import numpy as np
+import torch
+from Prepare import *
+import Utils.ComputingUtils as ComputingUtils
+import Variables.PreComputed as PreComputed
+import Variables.Residuals as Residuals
+import Variables.State as State
+
+enabled = False
+out = 'Results/Paths'
+chain_ids = [0]
+arrays = []
+kept = 0 # Draws already written to the arrays
+buffer = []
+generators = [] # Per-chain, apart from State.generators
+
+def seed_generators(seeds: list[int]):
+    # Seeded from each chain's seed, so enabling paths leaves the Gibbs draws unchanged
+    global generators
+    generators = ComputingUtils.chain_generators(
+        [torch.randint(0, 2**62, (1,), generator=g).item() for g in ComputingUtils.chain_generators(seeds)])
+
+def draw_standard_normal(*shape: int):
+    return torch.stack([torch.randn(shape, generator=g) for g in generators]).to(PreComputed.device)
+
+def reset():
+    global kept, buffer
+    kept = 0
+    buffer = []
+
+def no_kept(burn_in: int, total_draws: int, skips: int = 1):
+    # Draws sample() keeps: every skips-th sweep after burn-in
+    return len(range(0, total_draws-burn_in, skips))
+
+def open_array(path: str, shape: tuple, resume: bool):
+    # r+ ignores shape, so a resumed file of another length is copied into one of the new length
+    if resume and os.path.exists(path):
+        old = np.lib.format.open_memmap(path, mode='r+')
+        if old.shape == shape:
+            return old
+        new = np.lib.format.open_memmap(path+'.tmp', mode='w+', dtype=np.float32, shape=shape)
+        keep = min(kept, old.shape[-1], shape[-1])
+        new[..., :keep] = old[..., :keep]
+        new.flush()
+        del old, new
+        os.replace(path+'.tmp', path)
+        return np.lib.format.open_memmap(path, mode='r+')
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+
+def open_arrays(no_draws: int, chains: list[int], resume: bool = False):
+    # no_draws: the kept draws per chain; resumed runs keep the paths written so far,
+    # missing files (a run resumed with paths for the first time) are created
+    global chain_ids, arrays
+    chain_ids = chains
+    arrays = []
+    for chain in chain_ids:
+        path = os.path.join(out, f"chain{chain}")
+        os.makedirs(path, exist_ok=True)
+        arrays.append((
+            open_array(os.path.join(path, "path_F_draws.npy"), (Tmax, no_draws), resume),
+            open_array(os.path.join(path, "paths_U_draws.npy"), (Tmax, n, no_draws), resume)
+        ))
+
+def level_increments(meas: torch.Tensor, ind_theta: torch.Tensor, s2: torch.Tensor):
+    # Increments over the last in-sample year given each unit's coefficients
+    h = PreComputed.mfcstu.shape[1]
+    z = draw_standard_normal(meas.shape[1], h)
+    return ComputingUtils.matvec(PreComputed.mfcstu[ind_theta], meas)+torch.sqrt(s2).unsqueeze(2)*ComputingUtils.matvec(
+        PreComputed.cholfcstu[ind_theta], z)
+
+def draw_paths():
+    h = PreComputed.mfcstfa.shape[0]
+    trend = torch.stack([State.f0, State.mu_m], dim=1)
+    S_a = State.F-State.S_m
+    S_a[:, :2] -= trend
+    dF = ComputingUtils.matvec(PreComputed.Xfcstf, trend)
+    dF += ComputingUtils.matvec(PreComputed.mfcstfm[State.ind_rho], State.S_m)+torch.sqrt(State.sigma_m2).unsqueeze(1)*ComputingUtils.matvec(
+        PreComputed.cholfcstfm[State.ind_rho], draw_standard_normal(h))
+    dF += ComputingUtils.matvec(PreComputed.mfcstfa, S_a)+torch.sqrt(State.sigma_Da2).unsqueeze(1)*ComputingUtils.matvec(
+        PreComputed.cholfcstfa, draw_standard_normal(h))
+
+    # Supergroups, groups and countries inherit the increments of the level above
+    dH = level_increments(State.H, State.ind_theta_h, State.omega2.unsqueeze(1)*State.kappa_h2)
+    dG = State.lambda_g.unsqueeze(2)*ComputingUtils.gather_units(dH, State.K)+level_increments(
+        Residuals.residual("g"), State.ind_theta_g, State.omega2.unsqueeze(1)*State.kappa_g2*(1-State.lambda_g**2))
+    dC = State.lambda_c.unsqueeze(2)*ComputingUtils.gather_units(dG, State.J)+level_increments(
+        Residuals.residual("c"), State.ind_theta_c, State.omega2.unsqueeze(1)*State.kappa_c2*(1-State.lambda_c**2))
+
+    fit_F = ComputingUtils.matvec(PreComputed.fit_weights, State.F)
+    fit_C = ComputingUtils.matvec(PreComputed.fit_weights, State.C)
+    path_F = torch.cat([fit_F, fit_F[:, -1:]+dF], dim=1)
+    path_U = torch.cat([fit_C, fit_C[:, :, -1:]+dC], dim=2)
+    return path_F, path_U
+
+def record():
+    path_F, path_U = draw_paths()
+    buffer.append((path_F.cpu(), path_U.cpu()))
+
+def flush():
+    global kept, buffer
+    if len(buffer) == 0:
+        return
+    F = torch.stack([b[0] for b in buffer]).numpy()
+    U = torch.stack([b[1] for b in buffer]).numpy()
+    # Draws go last, as in the baseline files
+    for c, (path_F, paths_U) in enumerate(arrays):
+        path_F[:, kept:kept+len(buffer)] = F[:, c].T
+        paths_U[:, :, kept:kept+len(buffer)] = U[:, c].transpose(2, 1, 0)
+        path_F.flush()
+        paths_U.flush()
+    kept += len(buffer)
+    buffer = []
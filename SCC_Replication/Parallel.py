@@ -0,0 +1,130 @@
+"""
+Runs independent Gibbs chains on a process pool. PreComputed is
+computed once by the parent and handed to the workers through
+shared memory
+"""
+
+import os
+import time
+import torch
+import torch.multiprocessing as mp
+from Draw import *
+import Variables.PreComputed as PreComputed
+import Variables.Store as Store
+import Variables.State as State
+import Variables.Summaries as Summaries
+import Forecast
+
+precomputed_names = [
+    "no_kappas", "no_lambdas", "no_rhos", "no_thetas", "no_sigmas",
+    "no_groups", "no_supergroups",
+    "Delta", "Deltainv",
+    "lambda_grid", "kappa_grid", "rho_grid", "sigma_grid",
+    "weights", "regions",
+    "Sigma_U", "Sigma_U_inv", "Chol_Sigma_U", "Det_Sigma_U",
+    "SuA", "A", "ASA", "region_pattern",
+    "Sigma_m", "Sigma_m_inv", "Det_Sigma_m",
+    "Sigma_A", "Sigma_A_inv",
+    "fit_weights", "Xfcstf",
+    "mfcstfm", "cholfcstfm", "mfcstfa", "cholfcstfa", "mfcstu", "cholfcstu"
+]
+
+shared = None
+
+def share_precomputed():
+    out = {}
+    for name in precomputed_names:
+        val = getattr(PreComputed, name)
+        if isinstance(val, torch.Tensor):
+            val.share_memory_()
+        out[name] = val
+    for r in PreComputed.regions:
+        for val in vars(r).values():
+            if isinstance(val, torch.Tensor):
+                val.share_memory_()
+    out["f0"] = State.f0
+    out["mu_m"] = State.mu_m
+    return out
+
+def init_worker(precomputed: dict,
+                threads: int,
+                flush_every: int,
+                save: bool,
+                recorded: dict,
+                summarize: bool,
+                paths: bool):
+    global shared
+    shared = precomputed
+    torch.set_num_threads(threads)
+    Store.flush_every = flush_every
+    Store.enabled = save
+    Store.recorded = recorded
+    Summaries.enabled = summarize
+    Forecast.enabled = paths
+    for name in precomputed_names:
+        setattr(PreComputed, name, shared[name])
+
+def run_chain(chain: int,
+              seed: int,
+              burn_in: int,
+              total_draws: int,
+              skips: int,
+              checkpoint_dir: str,
+              checkpoint_every: int,
+              resume: bool):
+    start = time.time()
+    # sample() rebinds PreComputed.Delta during burn-in, so each chain starts from the shared one
+    PreComputed.Delta = shared["Delta"]
+    PreComputed.Deltainv = shared["Deltainv"]
+    State.f0 = shared["f0"]
+    State.mu_m = shared["mu_m"]
+    Store.reset([chain])
+    # Without a checkpoint directory the chain neither resumes nor checkpoints
+    checkpoint_path = None if checkpoint_dir is None else os.path.join(checkpoint_dir, f"chain{chain}.pt")
+    if resume and checkpoint_path is not None and os.path.exists(checkpoint_path):
+        sweep, Delta = load_checkpoint(checkpoint_path)
+    else:
+        initialize(
+            PreComputed.regions,
+            PreComputed.no_kappas,
+            PreComputed.no_lambdas,
+            PreComputed.no_thetas,
+            1,
+            [seed]
+        )
+        sweep, Delta = 0, None
+    if Forecast.enabled:
+        Forecast.open_arrays(Forecast.no_kept(burn_in, total_draws, skips), [chain], resume and sweep > 0)
+    sample(burn_in, total_draws, skips, start=sweep, Delta=Delta,
+           checkpoint_path=checkpoint_path, checkpoint_every=checkpoint_every)
+    Store.write()
+    Forecast.flush()
+    if Summaries.enabled:
+        Summaries.write([chain])
+    return time.time()-start
+
+def run_chains(n_chains: int,
+               processes: int,
+               burn_in: int,
+               total_draws: int,
+               seed: int = 0,
+               skips: int = 1,
+               threads: int = None,
+               checkpoint_dir: str = None,
+               checkpoint_every: int = 0,
+               resume: bool = False):
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1)//processes)
+    g = torch.Generator()
+    g.manual_seed(seed)
+    seeds = torch.randint(0, 2**62, (n_chains,), generator=g).tolist()
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(processes, initializer=init_worker,
+                  initargs=(share_precomputed(), threads,
+                            Store.flush_every, Store.enabled, Store.recorded,
+                            Summaries.enabled, Forecast.enabled)) as pool:
+        times = pool.starmap(run_chain, [
+            (c, seeds[c], burn_in, total_draws, skips, checkpoint_dir, checkpoint_every, resume)
+            for c in range(n_chains)
+        ])
+    return times
@@ -1,9 +1,11 @@
 import torch
 import csv
+import hashlib
+import os
 import Variables.State as State
 import Variables.PreComputed as PreComputed
 import Utils.ComputingUtils as ComputingUtils
-import statsmodels.api as sm
+import Utils.FileUtils as FileUtils
 
 T: int = 118 # Minimum number of years for a country
 maxh: int = 100 # Offset between minimum and maximum number of years
@@ -75,117 +77,71 @@ def baseline_trend(Deltavar: float = 0.01**2):
     G = torch.matmul(Fw_, torch.linalg.inv(torch.matmul(Fw_.t(), Fw_)))
     return Xraw, Fw, Delta, Deltainv, Xfcstf, cutoff, G, SRW
 
-def Sigma_M(rho_grid: torch.Tensor, R: torch.Tensor):
-    rho_grid = PreComputed.rho_grid
-    no_rhos = len(rho_grid)
-    ssv = torch.zeros(Tmax).to(PreComputed.device)
-    sfmss = torch.zeros(25).to(PreComputed.device).unsqueeze(1)
-    Sigma_m = torch.zeros((no_rhos, q+1, q+1)).to(PreComputed.device)
-    Sigma_m_inv = torch.zeros((no_rhos, q+1, q+1)).to(PreComputed.device)
-    Chol_Sigma_m = torch.zeros((no_rhos, q+1, q+1)).to(PreComputed.device)
-    Det_Sigma_m = torch.zeros((no_rhos, 2)).to(PreComputed.device)
-    mfcstfm = torch.zeros((no_rhos, 100, q+1)).to(PreComputed.device)
-    cholfcstfm = torch.zeros((no_rhos, 100, 100)).to(PreComputed.device)
+def integrated_projection(R: torch.Tensor):
+    # A'R for the lower-triangular summation matrix A, shared by Sigma_M and Sigma_a
+    rows = torch.arange(1, Tmax+1).unsqueeze(1)
+    cols = torch.arange(1, Tmax+1).unsqueeze(0)
+    A = (rows>=cols).float().to(PreComputed.device)
+    return torch.matmul(A.t(), R)
 
+def Sigma_M(rho_grid: torch.Tensor, AR: torch.Tensor):
+    ssv = torch.zeros(Tmax).to(PreComputed.device)
     ssv[0] = -1
     ssv[51] = 1
     rows = torch.arange(1, Tmax+1).unsqueeze(1)
     cols = torch.arange(1, Tmax+1).unsqueeze(0)
-    A = (rows>=cols).float().to(PreComputed.device)
     exps = torch.abs(rows-cols).to(PreComputed.device)
-    for i, rho in enumerate(rho_grid):
-        Sraw = rho**exps
-        Sraw = torch.linalg.multi_dot([A, Sraw, A.t()])
-        sfmss[i] = torch.linalg.multi_dot([ssv.t(), Sraw, ssv])
-        Sall = torch.linalg.multi_dot([R.t(), Sraw, R])
-        S = Sall[:(q+1), :(q+1)]
-        Sigma_m[i] = S
-        Sigma_m_inv[i] = torch.linalg.inv(S)
-        m,e = ComputingUtils.det(S)
-        Det_Sigma_m[i,0] = m
-        Det_Sigma_m[i,1] = e
-        Chol_Sigma_m[i] = torch.linalg.cholesky(S)
-        mfcstfm[i] = torch.matmul(Sall[(q+1):, :(q+1)], Sigma_m_inv[i])
-        cholfcstfm[i] = Sall[(q+1):,(q+1):]-torch.matmul(mfcstfm[i], Sall[:(q+1),(q+1):])
-    Det_Sigma_m[:, 0] = torch.log(torch.abs(Det_Sigma_m[:,0]))
-    Det_Sigma_m[:, 1] = Det_Sigma_m[:, 1]*torch.log(torch.tensor(10))
-    Det_Sigma_m = -0.5*Det_Sigma_m[:, 0]-0.5*Det_Sigma_m[:, 1]
-    return Sigma_m, Sigma_m_inv, Det_Sigma_m, Chol_Sigma_m, mfcstfm, cholfcstfm, ssv, torch.tensor(50).to(PreComputed.device)
-
-def Sigma_a(R: torch.Tensor, ssv: torch.Tensor):
-    rows = torch.arange(1, Tmax+1).unsqueeze(1)
-    cols = torch.arange(1, Tmax+1).unsqueeze(0)
-    A = (rows>=cols).float().to(PreComputed.device)
-    Sraw = torch.matmul(A, A.t())
-    sfass = torch.linalg.multi_dot([ssv.t(), Sraw, ssv])
-    Sall = torch.linalg.multi_dot([R.t(),Sraw, R])
+    # (rho x Tmax x Tmax) AR(1) covariances, projected through A'R in one batched product.
+    # Built in float64: the conditional forecast covariance is indefinite in float32
+    Sraw = rho_grid.double().view(-1, 1, 1)**exps
+    Sall = torch.matmul(AR.double().t(), torch.matmul(Sraw, AR.double()))
+    Sigma_m = Sall[:, :(q+1), :(q+1)].float()
+    # Sigma_m reaches condition numbers around 1e8, too many for a float32 log-determinant
+    Chol_Sigma_m, Sigma_m_inv, Det_Sigma_m = [x.float() for x in ComputingUtils.spd_factor(Sigma_m.double())]
+    mfcstfm = torch.linalg.solve(Sall[:, :(q+1), :(q+1)], Sall[:, :(q+1), (q+1):]).transpose(1, 2)
+    cholfcstfm = torch.linalg.cholesky(Sall[:, (q+1):, (q+1):]-torch.matmul(mfcstfm, Sall[:, :(q+1), (q+1):]))
+    return Sigma_m, Sigma_m_inv, Det_Sigma_m, Chol_Sigma_m, mfcstfm.float(), cholfcstfm.float(), ssv, torch.tensor(50).to(PreComputed.device)
+
+def Sigma_a(AR: torch.Tensor):
+    Sall = torch.matmul(AR.t(), AR)
     S = Sall[:(q+1), :(q+1)]
     Sigma_A = S
-    Chol_Sigma_A = torch.linalg.cholesky(S)
-    Sigma_A_inv = torch.linalg.inv(S)
+    Chol_Sigma_A, Sigma_A_inv, _ = ComputingUtils.spd_factor(S)
     mfcstfa = torch.matmul(Sall[(q+1):,:(q+1)], Sigma_A_inv)
     cholfcstfa = torch.linalg.cholesky(Sall[(q+1):, (q+1):]-torch.matmul(mfcstfa, Sall[:(q+1), (q+1):]))
 
     return Sigma_A, Sigma_A_inv, Chol_Sigma_A, mfcstfa, cholfcstfa
 
-def thetas(no_thetas: int=100):
-    gammas = torch.zeros((kmax+1, no_thetas)).to(PreComputed.device)
-    corr = torch.zeros(kmax+1,2).to(PreComputed.device)
-    half_life_dist = torch.zeros(no_thetas).to(PreComputed.device)
-    theta = torch.zeros((3,no_thetas)).to(PreComputed.device)
-
-    for i in range(no_thetas):
-        x = torch.rand(3).to(PreComputed.device)
-        hl = 25+775*x[:2]**2
-        r = 2**(-1/hl)
-        for j in range(kmax+1):
-            corr[j] = r**j
-        gammas[:,i] = torch.matmul(corr, torch.tensor([x[2],1-x[2]]).to(PreComputed.device))
-        cond = gammas[1:, i] > 0.5
-        half_life_dist[i] = cond.sum()
-        theta[:,i] = torch.tensor([r[0],r[1],x[2]]).to(PreComputed.device)
+def thetas(no_thetas: int=100, seed: int=0):
+    g = torch.Generator()
+    g.manual_seed(seed)
+    x = torch.rand((no_thetas, 3), generator=g).to(PreComputed.device)
+    hl = 25+775*x[:, :2]**2
+    r = 2**(-1/hl)
+    # (lags x thetas x 2) autocorrelations of both AR(1) components in one power
+    lags = torch.arange(kmax+1).float().to(PreComputed.device).view(-1, 1, 1)
+    corr = r.unsqueeze(0)**lags
+    gammas = corr[:, :, 0]*x[:, 2]+corr[:, :, 1]*(1-x[:, 2])
+    half_life_dist = torch.sum(gammas[1:] > 0.5, dim=0).float()
+    theta = torch.stack([r[:, 0], r[:, 1], x[:, 2]])
 
     return gammas, half_life_dist, theta
 
-def setSfromga(ga):
-    gax = torch.zeros(2*Tmax-1).to(PreComputed.device)
-    gax[Tmax-1] = ga[0]
-    S = torch.zeros(Tmax, Tmax).to(PreComputed.device)
-    for k in range(1,Tmax):
-        gax[k+Tmax-1] = ga[k]
-        gax[Tmax-1-k] = ga[k]
-    for k in range(Tmax):
-        S[:,k] = gax[(Tmax-1-k):(2*Tmax-1-k)]
-    return S
+def toeplitz_from_gammas(gammas: torch.Tensor):
+    # S[k,i,j] = gammas[|i-j|, k]: one Tmax x Tmax Toeplitz matrix per column of gammas
+    rows = torch.arange(Tmax).unsqueeze(1)
+    cols = torch.arange(Tmax).unsqueeze(0)
+    lags = torch.abs(rows-cols).to(PreComputed.device)
+    return gammas.t()[:, lags]
 
 def Sigma_Us(gammas: torch.Tensor, R: torch.Tensor, ssv: torch.Tensor, no_thetas: int=100):
-    Sigma_U = torch.zeros((no_thetas, q+1, q+1)).to(PreComputed.device)
-    Sigma_U_inv = torch.zeros((no_thetas, q+1, q+1)).to(PreComputed.device)
-    Chol_Sigma_U = torch.zeros((no_thetas, q+1, q+1)).to(PreComputed.device)
-    Det_Sigma_U = torch.zeros((no_thetas, 2)).to(PreComputed.device)
-    mfcstu = torch.zeros((100, q+1, 100)).to(PreComputed.device)
-    sfcstu = torch.zeros((100, 100, 100)).to(PreComputed.device)
-    cholfcstu = torch.zeros((100,100,100)).to(PreComputed.device)
-    suss = torch.zeros(100).to(PreComputed.device).unsqueeze(1)
-
-    for i in range(100):
-        Sraw = setSfromga(gammas[:, i])
-        Sall = torch.linalg.multi_dot([R.t(), Sraw, R])
-        S = Sall[:(q+1),:(q+1)]
-        Sigma_U[i] = S
-        m, e = ComputingUtils.det(S)
-        Det_Sigma_U[i,0] = m
-        Det_Sigma_U[i,1] = e
-        Chol_Sigma_U[i] = torch.linalg.cholesky(S)
-        Sigma_U_inv[i] = torch.linalg.inv(S)
-        mfcstu[:,:,i] = torch.matmul(Sall[(q+1):, :(q+1)], Sigma_U_inv[i])
-        sfcstu[:,:,i] = Sall[(q+1):,(q+1):]-torch.matmul(mfcstu[:,:,i], Sall[:(q+1),(q+1):])
-        cholfcstu[:,:,i] = torch.linalg.cholesky(sfcstu[:,:,i])
-        suss[i] = torch.linalg.multi_dot([ssv.t(),Sraw,ssv])
-
-    Det_Sigma_U[:, 0] = torch.log(torch.abs(Det_Sigma_U[:,0]))
-    Det_Sigma_U[:, 1] = Det_Sigma_U[:, 1]*torch.log(torch.tensor(10).to(PreComputed.device))
-    Det_Sigma_U = -0.5*Det_Sigma_U[:, 0]-0.5*Det_Sigma_U[:, 1]
+    Sraw = toeplitz_from_gammas(gammas[:, :no_thetas])
+    Sall = torch.matmul(R.t(), torch.matmul(Sraw, R))
+    Sigma_U = Sall[:, :(q+1), :(q+1)]
+    Chol_Sigma_U, Sigma_U_inv, Det_Sigma_U = ComputingUtils.spd_factor(Sigma_U)
+    mfcstu = torch.matmul(Sall[:, (q+1):, :(q+1)], Sigma_U_inv)
+    sfcstu = Sall[:, (q+1):, (q+1):]-torch.matmul(mfcstu, Sall[:, :(q+1), (q+1):])
+    cholfcstu = torch.linalg.cholesky(sfcstu)
     return Sigma_U, Sigma_U_inv, Chol_Sigma_U, Det_Sigma_U, mfcstu, cholfcstu, sfcstu
 
 def getlfweights(sel: torch.Tensor, 
@@ -204,41 +160,25 @@ def getlfweights(sel: torch.Tensor,
     w[:, 2:] = evecs[:, :qw]
     return w
 
-def setRegionwA(r: Region, 
-                ind: int, 
-                sel: torch.Tensor, 
-                V: torch.Tensor, 
-                cutoff: float, 
-                Xraw: torch.Tensor, 
-                R: torch.Tensor,
-                Sigma_U: torch.Tensor,
-                SuAA: torch.Tensor,
-                SuAAS: torch.Tensor):
-    notnans = []
-    notnans.append(sel[0].item())
-    for i in range(1,T-1):
-        notnans.append(sel[i-1] or sel[i+1])
-    notnans.append(sel[len(sel)-1].item())
-    notnans = torch.tensor(notnans).to(PreComputed.device)
-    r.w = getlfweights(notnans, V, cutoff, Xraw)
-    r.qi = r.w.shape[1]-1
-    AB = torch.zeros((q+1, q+1)).to(PreComputed.device)
-    R_n = R[:T, :(q+1)].numpy()
-    for i in range(r.qi+1):
-        w_n = r.w[:,i].numpy()
-        model = sm.OLS(w_n,R_n)
-        results = model.fit()
-        params = torch.tensor(results.params)
-        AB[i,:] = params.to(PreComputed.device)
-    AB[(r.qi+2):, :] = 0
-    for i in range(r.qi+1, q+1):
-        AB[i][i] = 1
-    AB = AB.t()
-    A = AB[:, :(r.qi+1)]
-    r.AApAi = torch.matmul(A, torch.linalg.inv(torch.matmul(A.t(), A)))
-    for i, Sigma in enumerate(Sigma_U):
-        SuAA[:,:,i,ind] = torch.linalg.multi_dot([Sigma, A, torch.linalg.inv(torch.linalg.multi_dot([A.t(), Sigma, A])), A.t()])
-    SuAAS[:,:,i,ind] = Sigma-torch.matmul(SuAA[:,:,i,ind], Sigma)
+def available_years(sel: torch.Tensor):
+    notnans = sel.clone()
+    notnans[1:-1] = sel[:-2] | sel[2:]
+    return notnans
+
+def pattern_artifacts(w: torch.Tensor,
+                      A: torch.Tensor,
+                      Sigma_U: torch.Tensor):
+    qi = w.shape[1]-1
+    AApAi = torch.matmul(A, torch.linalg.inv(torch.matmul(A.t(), A)))
+    # Sigma A (A'Sigma A)^-1 for every theta at once: SuAA = SuA A' and SuAAS = Sigma-SuA (Sigma A)'
+    SA = torch.matmul(Sigma_U, A)
+    ASA = torch.matmul(A.t(), SA)
+    SuA = torch.matmul(SA, torch.linalg.inv(ASA))
+    return w, qi, AApAi, A, SuA, ASA
+
+def setRegionwA(r: Region,
+                artifacts: tuple):
+    r.w, r.qi, r.AApAi = artifacts[:3]
 
 def loadRegions(no_thetas: int,
                 pop_path: str,
@@ -249,8 +189,6 @@ def loadRegions(no_thetas: int,
                 Xraw: torch.Tensor,
                 Sigma_U: torch.Tensor):
     regions: list[Region] = [Region() for _ in range(n)]
-    SuAA = torch.zeros((q+1, q+1, no_thetas, n)).to(PreComputed.device)
-    SuAAS = torch.zeros((q+1, q+1, no_thetas, n)).to(PreComputed.device)
 
     mdata = torch.zeros((T, n)).to(PreComputed.device)
     with open(pop_path, 'r') as file:
@@ -278,15 +216,91 @@ def loadRegions(no_thetas: int,
     F = F/weff
     State.f0 = F[0]
     State.mu_m = F[1]
+    # Regions with the same available years share every projection artifact
+    patterns = {}
+    for i in range(n):
+        notnans = available_years(~torch.isnan(leveldata[:,i]))
+        patterns.setdefault(tuple(notnans.tolist()), []).append(i)
+    ws = [getlfweights(torch.tensor(key).to(PreComputed.device), V, cutoff, Xraw) for key in patterns]
+    # One least-squares solve regresses the weight columns of every pattern on R
+    coefs = torch.linalg.lstsq(R[:T, :(q+1)], torch.cat(ws, dim=1)).solution
+    ranks = [w.shape[1] for w in ws]
+    As = torch.split(coefs, ranks, dim=1)
+    # Factors are stored once per pattern, zero-padded beyond each pattern's rank
+    SuA = torch.zeros((no_thetas, len(patterns), q+1, max(ranks))).to(PreComputed.device)
+    A = torch.zeros((len(patterns), q+1, max(ranks))).to(PreComputed.device)
+    ASA = torch.zeros((no_thetas, len(patterns), max(ranks), max(ranks))).to(PreComputed.device)
+    region_pattern = torch.zeros(n, dtype=torch.long).to(PreComputed.device)
+    for p, (inds, w, Ai) in enumerate(zip(patterns.values(), ws, As)):
+        artifacts = pattern_artifacts(w, Ai, Sigma_U)
+        A[p, :, :w.shape[1]] = Ai
+        SuA[:, p, :, :w.shape[1]] = artifacts[4]
+        ASA[:, p, :w.shape[1], :w.shape[1]] = artifacts[5]
+        region_pattern[inds] = p
+        for i in inds:
+            setRegionwA(regions[i], artifacts)
     for i, r in enumerate(regions):
-        setRegionwA(r, i, ~torch.isnan(leveldata[:,i]), V, cutoff, Xraw, R, Sigma_U, SuAA, SuAAS)
         filtered = torch.where(~torch.isnan(leveldata[:,i]), leveldata[:,i], torch.tensor(1).to(PreComputed.device))
         r.Y = torch.matmul(r.w.t(), torch.log(filtered))
     
-    return regions, F, SuAA, SuAAS, weights
+    return regions, F, SuA, A, ASA, region_pattern, weights
+
+cache_version = 12 # Bump whenever the precomputation itself changes
+
+cached_names = [
+    "kappa_grid", "lambda_grid", "rho_grid", "sigma_grid",
+    "Delta", "Deltainv",
+    "Sigma_m", "Sigma_m_inv", "Det_Sigma_m",
+    "Sigma_A", "Sigma_A_inv",
+    "Sigma_U", "Sigma_U_inv", "Chol_Sigma_U", "Det_Sigma_U",
+    "SuA", "A", "ASA", "region_pattern", "weights",
+    "fit_weights", "Xfcstf",
+    "mfcstfm", "cholfcstfm", "mfcstfa", "cholfcstfa", "mfcstu", "cholfcstu"
+]
+
+def cache_key(pop_path: str, yp_path: str):
+    h = hashlib.sha256()
+    for path in [pop_path, yp_path]:
+        with open(path, 'rb') as file:
+            h.update(file.read())
+    h.update(repr((
+        PreComputed.no_kappas, PreComputed.no_lambdas, PreComputed.no_rhos,
+        PreComputed.no_thetas, PreComputed.no_sigmas, PreComputed.theta_seed,
+        PreComputed.Deltavar, T, maxh, n, q, q0, kmax, cache_version
+    )).encode())
+    return h.hexdigest()
+
+def save_cache(path: str, theta: torch.Tensor, R: torch.Tensor):
+    cache = {name: getattr(PreComputed, name) for name in cached_names}
+    cache["regions"] = [vars(r) for r in PreComputed.regions]
+    cache["f0"] = State.f0
+    cache["mu_m"] = State.mu_m
+    cache["theta"] = theta
+    cache["R"] = R
+    FileUtils.write_torch(cache, path)
+
+def load_cache(path: str):
+    cache = FileUtils.read_torch(path)
+    for name in cached_names:
+        setattr(PreComputed, name, cache[name].to(PreComputed.device))
+    PreComputed.regions = []
+    for attrs in cache["regions"]:
+        r = Region()
+        for name, val in attrs.items():
+            setattr(r, name, val.to(PreComputed.device) if isinstance(val, torch.Tensor) else val)
+        PreComputed.regions.append(r)
+    State.f0 = cache["f0"].to(PreComputed.device)
+    State.mu_m = cache["mu_m"].to(PreComputed.device)
+    return cache["theta"].to(PreComputed.device), cache["R"].to(PreComputed.device)
 
 def precompute(pop_path: str,
-               yp_path: str):
+               yp_path: str,
+               use_cache: bool = True):
+    # The outputs only depend on the data files, the grid sizes and the theta seed
+    cache_path = os.path.join(PreComputed.cache_dir, cache_key(pop_path, yp_path)+'.pt')
+    if use_cache and os.path.exists(cache_path):
+        return load_cache(cache_path)
+
     PreComputed.kappa_grid, PreComputed.lambda_grid, PreComputed.rho_grid, PreComputed.sigma_grid = grids(
         PreComputed.no_kappas,
         PreComputed.no_lambdas,
@@ -294,19 +308,23 @@ def precompute(pop_path: str,
         PreComputed.no_sigmas
     )
     
-    Xraw, R, PreComputed.Delta, PreComputed.Deltainv, Xfcstf, cutoff, G, V = baseline_trend(PreComputed.Deltavar)
+    Xraw, R, PreComputed.Delta, PreComputed.Deltainv, PreComputed.Xfcstf, cutoff, PreComputed.fit_weights, V = baseline_trend(PreComputed.Deltavar)
+
+    AR = integrated_projection(R)
 
-    PreComputed.Sigma_m, PreComputed.Sigma_m_inv, PreComputed.Det_Sigma_m, Chol_Sigma_m, mfcstfm, cholfcstfm, ssv, ssh = Sigma_M(
-        PreComputed.rho_grid, R)
+    PreComputed.Sigma_m, PreComputed.Sigma_m_inv, PreComputed.Det_Sigma_m, Chol_Sigma_m, PreComputed.mfcstfm, PreComputed.cholfcstfm, ssv, ssh = Sigma_M(
+        PreComputed.rho_grid, AR)
     
-    PreComputed.Sigma_A, PreComputed.Sigma_A_inv, Chol_Sigma_A, mfcstfa, cholfcstfa = Sigma_a(R, ssv)
+    PreComputed.Sigma_A, PreComputed.Sigma_A_inv, Chol_Sigma_A, PreComputed.mfcstfa, PreComputed.cholfcstfa = Sigma_a(AR)
 
-    gammas, half_life_dist, theta = thetas(PreComputed.no_thetas)
+    gammas, half_life_dist, theta = thetas(PreComputed.no_thetas, PreComputed.theta_seed)
 
-    Sigma_U, PreComputed.Sigma_U_inv, PreComputed.Chol_Sigma_U, PreComputed.Det_Sigma_U,  mfcstu, cholfcstu, Sfcstu = Sigma_Us(
+    PreComputed.Sigma_U, PreComputed.Sigma_U_inv, PreComputed.Chol_Sigma_U, PreComputed.Det_Sigma_U, PreComputed.mfcstu, PreComputed.cholfcstu, Sfcstu = Sigma_Us(
         gammas,R, ssv,PreComputed.no_thetas)
     
-    PreComputed.regions, F, PreComputed.SuAA, PreComputed.SuAAS, PreComputed.weights = loadRegions(
-        PreComputed.no_thetas, pop_path,yp_path,R,V,cutoff,Xraw,Sigma_U)
+    PreComputed.regions, F, PreComputed.SuA, PreComputed.A, PreComputed.ASA, PreComputed.region_pattern, PreComputed.weights = loadRegions(
+        PreComputed.no_thetas, pop_path,yp_path,R,V,cutoff,Xraw,PreComputed.Sigma_U)
     
+    if use_cache:
+        save_cache(cache_path, theta.t(), R)
     return theta.t(), R
\ No newline at end of file
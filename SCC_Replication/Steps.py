@@ -1,498 +1,323 @@
 import torch
 import Utils.ComputingUtils as ComputingUtils
+import Utils.GridUtils as GridUtils
 import Variables.State as State
+import Variables.Residuals as Residuals
 from Prepare import *
 
-def step1(Chol_Sigma_U: torch.Tensor, 
-          SuAA: torch.Tensor, 
-          SuAAS: torch.Tensor,
+def step1(Sigma_U: torch.Tensor,
+          Chol_Sigma_U: torch.Tensor,
+          SuA: torch.Tensor,
+          A: torch.Tensor,
+          ASA: torch.Tensor,
+          region_pattern: torch.Tensor,
           weights: torch.Tensor,
           Delta: torch.Tensor): # Draw X, C
-    fhat = torch.zeros(q+1).to(PreComputed.device)
-    sVs = torch.zeros((q+1,q+1)).to(PreComputed.device)
-
-    # s2 = (1-State.lambda_c**2)*State.kappa_c2*State.omega2
-    # for ind, i in enumerate(State.J):
-    #     mu_C = State.lambda_c[ind]*State.G[i]
-    #     mu_C[0] += State.mu_c
-    #     u = ComputingUtils.draw_standard_normal(q+1)
-    #     u = torch.sqrt(s2[ind])*torch.matmul(Chol_Sigma_U[State.ind_theta_c[ind]],
-    #                                           u)+mu_C
-    #     State.C[ind] = u - torch.matmul(SuAA[:,:,State.ind_theta_c[ind], ind],
-    #                                      u-State.C[ind])
-    #     if weights[ind] > 0:
-    #         fhat += weights[ind]*State.C[ind]
-    #         sVs += weights[ind]**2*s2[ind]*SuAAS[:,:,State.ind_theta_c[ind],ind]
-    
-    # e = ComputingUtils.draw_standard_normal(q+1)
-    # e = State.Y0+torch.matmul(torch.linalg.cholesky(Delta), e)
-    # fhat = torch.matmul(torch.linalg.inv(sVs+Delta), fhat-e)
-    
-    # for i,w in enumerate(weights):
-    #     if w > 0:
-    #         State.C[i] -= w*s2[i]*torch.matmul(SuAAS[:,:,State.ind_theta_c[i],i], fhat)
-    #     State.X[i] = State.C[i]+State.F
-    s2 = State.omega2*State.kappa_c2*(1-State.lambda_c**2)
-    for ind, i in enumerate(State.J):
-        m = State.lambda_c[ind]*State.G[i]
-        m[0] += State.mu_c
-        u = ComputingUtils.draw_standard_normal(q+1)
-        u = torch.sqrt(s2[ind])*torch.matmul(Chol_Sigma_U[State.ind_theta_c[ind]], u)+m
-        State.C[ind] = u-torch.matmul(SuAA[:,:,State.ind_theta_c[ind],ind], u-State.C[ind])
-        if weights[ind]>0:
-            fhat += weights[ind]*State.C[ind]
-            sVs += weights[ind]**2*s2[ind]*SuAAS[:,:,State.ind_theta_c[ind], ind]
+    w = torch.where(weights > 0, weights, torch.zeros_like(weights))
+    # Only countries with positive weight enter fhat and its correction
+    pos = torch.nonzero(w > 0).squeeze(1)
+    s2 = State.omega2.unsqueeze(1)*State.kappa_c2*(1-State.lambda_c**2)
+
+    m = State.lambda_c.unsqueeze(2)*ComputingUtils.gather_units(State.G, State.J)
+    m[:, :, 0] += State.mu_c.unsqueeze(1)
+    u = ComputingUtils.draw_standard_normal(n, q+1)
+    u = torch.sqrt(s2).unsqueeze(2)*ComputingUtils.matvec(Chol_Sigma_U[State.ind_theta_c], u)+m
+    # SuAA = SuA A' per (chain, country), gathered through the country's missingness pattern
+    C = u-ComputingUtils.matvec(SuA[State.ind_theta_c, region_pattern],
+                                ComputingUtils.matvec(A[region_pattern].transpose(1, 2), u-State.C))
+    fhat = torch.sum(w.view(1, -1, 1)*C, dim=1)
+
+    # SuAAS = Sigma-SuA (Sigma A)' with Sigma A = SuA ASA, so
+    # sVs = sum_i c_i Sigma_i - sum_i (c_i SuA_i ASA_i) SuA_i', c_i = w_i^2 s2_i
+    ind_theta = State.ind_theta_c[:, pos]
+    ws2 = w[pos]*s2[:, pos]
+    SuA_P = SuA[ind_theta, region_pattern[pos]]
+    A_P = A[region_pattern[pos]]
+    coef = torch.zeros((State.n_chains, len(Sigma_U))).to(PreComputed.device).scatter_add_(1, ind_theta, w[pos]*ws2)
+    cSuAM = (w[pos]*ws2).view(*ws2.shape, 1, 1)*torch.matmul(SuA_P, ASA[ind_theta, region_pattern[pos]])
+    sVs = torch.einsum('ct,tij->cij', coef, Sigma_U)-torch.einsum('cpir,cpjr->cij', cSuAM, SuA_P)
 
     e = ComputingUtils.draw_standard_normal(q+1)
-    e = State.Y0+torch.matmul(torch.linalg.cholesky(Delta),e)
-    fhat = torch.matmul(torch.linalg.inv(sVs+Delta), fhat-e)
-    for ind in range(n):
-        if weights[ind] > 0:
-            State.C[ind] -= weights[ind]*s2[ind]*torch.matmul(SuAAS[:,:,State.ind_theta_c[ind], ind], fhat)
-        State.X[ind] = State.C[ind]+State.F
+    e = State.Y0+ComputingUtils.matvec(torch.linalg.cholesky(Delta), e)
+    fhat = ComputingUtils.matvec(torch.linalg.inv(sVs+Delta), fhat-e)
+    # SuAAS_i fhat = Sigma_i fhat-SuA_i (A_i' Sigma_i fhat), from Sigma fhat at every theta
+    Sf = ComputingUtils.gather_units(torch.einsum('tij,cj->cti', Sigma_U, fhat), ind_theta)
+    Sf = Sf-ComputingUtils.matvec(SuA_P, ComputingUtils.matvec(A_P.transpose(1, 2), Sf))
+    C[:, pos] -= ws2.unsqueeze(2)*Sf
+    State.C = C
+    State.X = State.C+State.F.unsqueeze(1)
+    Residuals.changed("C")
 
 def step2(Sigma_U_inv: torch.Tensor): # G
-    V_g = torch.zeros((25,q+1,q+1)).to(PreComputed.device)
-    ms = torch.zeros((25,q+1)).to(PreComputed.device)
-
-    s2 = (1-State.lambda_g**2)*State.kappa_g2*State.omega2
-    for i,k in enumerate(State.K):
-        V_g[i] = Sigma_U_inv[State.ind_theta_g[i]]/s2[i]
-        ms[i] = torch.matmul(V_g[i], State.lambda_g[i]*State.H[k])
-    
-    s2 = (1-State.lambda_c**2)*State.kappa_c2*State.omega2
-    for ind, i in enumerate(State.J):
-        u = State.C[ind]
-        u[0] -= State.mu_c
-        V_g[i] += State.lambda_c[ind]**2*Sigma_U_inv[State.ind_theta_c[ind]]/s2[ind]
-        ms[i] += State.lambda_c[ind]*torch.matmul(
-            Sigma_U_inv[State.ind_theta_c[ind]],u)/s2[ind]
-    
-    for i,V in enumerate(V_g):
-        inv_V = torch.linalg.inv(V)
-        g = ComputingUtils.draw_standard_normal(q+1)
-        State.G[i] = torch.matmul(torch.linalg.cholesky(inv_V),
-                                   g)+torch.matmul(inv_V, ms[i])
+    s2 = (1-State.lambda_g**2)*State.kappa_g2*State.omega2.unsqueeze(1)
+    V_g = Sigma_U_inv[State.ind_theta_g]/s2.view(*s2.shape, 1, 1)
+    ms = ComputingUtils.matvec(V_g, State.lambda_g.unsqueeze(2)*ComputingUtils.gather_units(State.H, State.K))
+
+    # Every country adds its precision and mean contribution to its group
+    s2 = (1-State.lambda_c**2)*State.kappa_c2*State.omega2.unsqueeze(1)
+    u = State.C.clone()
+    u[:, :, 0] -= State.mu_c.unsqueeze(1)
+    S = Sigma_U_inv[State.ind_theta_c]/s2.view(*s2.shape, 1, 1)
+    J = State.J.view(*State.J.shape, 1, 1)
+    V_g.scatter_add_(1, J.expand_as(S), State.lambda_c.view(*s2.shape, 1, 1)**2*S)
+    ms.scatter_add_(1, J[..., 0].expand_as(u), State.lambda_c.unsqueeze(2)*ComputingUtils.matvec(S, u))
+
+    State.G = ComputingUtils.draw_from_precision(V_g, ms)
+    Residuals.changed("G")
 
 def step3(Sigma_U_inv): # H
-    V_h = torch.zeros((10,q+1,q+1)).to(PreComputed.device)
-    ms = torch.zeros((10,q+1)).to(PreComputed.device)
-
-    s2 = State.kappa_h2*State.omega2
-    for k in range(10):
-        V_h[k] = Sigma_U_inv[State.ind_theta_h[k]]/s2[k]
-    
-    s2 = (1-State.lambda_g**2)*State.kappa_g2*State.omega2
-    for i,k in enumerate(State.K):
-        u = State.G[i]
-        V_h[k] += State.lambda_g[i]**2*Sigma_U_inv[State.ind_theta_g[i]]/s2[i]
-        ms[k] += State.lambda_g[i]*torch.matmul(
-            Sigma_U_inv[State.ind_theta_g[i]],u)/s2[i]
-        
-    for k,V in enumerate(V_h):
-        inv_V = torch.linalg.inv(V)
-        h = ComputingUtils.draw_standard_normal(q+1)
-        State.H[k] = torch.matmul(torch.linalg.cholesky(inv_V),
-                                  h)+torch.matmul(inv_V,ms[k])
-        
+    s2 = State.kappa_h2*State.omega2.unsqueeze(1)
+    V_h = Sigma_U_inv[State.ind_theta_h]/s2.view(*s2.shape, 1, 1)
+    ms = torch.zeros(State.H.shape).to(PreComputed.device)
+
+    s2 = (1-State.lambda_g**2)*State.kappa_g2*State.omega2.unsqueeze(1)
+    S = Sigma_U_inv[State.ind_theta_g]/s2.view(*s2.shape, 1, 1)
+    K = State.K.view(*State.K.shape, 1, 1)
+    V_h.scatter_add_(1, K.expand_as(S), State.lambda_g.view(*s2.shape, 1, 1)**2*S)
+    ms.scatter_add_(1, K[..., 0].expand_as(State.G), State.lambda_g.unsqueeze(2)*ComputingUtils.matvec(S, State.G))
+
+    State.H = ComputingUtils.draw_from_precision(V_h, ms)
+    Residuals.changed("H")
+
 def step4(Sigma_U_inv: torch.Tensor,
           lambda_grid: torch.Tensor): # lambda_c
-    prob = torch.zeros(len(lambda_grid)).to(PreComputed.device)
-    for ind, i in enumerate(State.J):
-        s2 = (1-lambda_grid**2)*State.kappa_c2[ind]*State.omega2
-        for l, lam in enumerate(lambda_grid):
-            u = State.C[ind]-lam*State.G[i]
-            u[0] -= State.mu_c
-            prob[l] = -0.5*torch.linalg.multi_dot([
-                u.t(),Sigma_U_inv[State.ind_theta_c[ind]],
-                u])/s2[l]-0.5*(q+1)*torch.log(s2[l])+torch.log(State.p_c_lambda[l])
-        prob = torch.exp(prob-torch.max(prob))
-        for l in range(1,25):
-            prob[l] += prob[l-1]
-        prob = prob/prob[-1]
-        l_ind = ComputingUtils.draw_proportional(prob)
-        State.lambda_c[ind] = lambda_grid[l_ind]
+    v = State.C.clone()
+    v[:, :, 0] -= State.mu_c.unsqueeze(1)
+    prob = GridUtils.lambda_log_prob(v, ComputingUtils.gather_units(State.G, State.J),
+                                     Sigma_U_inv[State.ind_theta_c],
+                                     State.kappa_c2*State.omega2.unsqueeze(1),
+                                     lambda_grid, State.p_c_lambda)
+    State.lambda_c = lambda_grid[ComputingUtils.draw_categorical(prob)]
+    Residuals.changed("lambda_c")
 
 def step5(Sigma_U_inv: torch.Tensor,
            lambda_grid: torch.Tensor): # lambda_g
-    prob = torch.zeros(len(lambda_grid)).to(PreComputed.device)
-    for i,k in enumerate(State.K):
-        s2 = (1-lambda_grid**2)*State.kappa_g2[i]*State.omega2
-        for l, lam in enumerate(lambda_grid):
-            u = State.G[i]-lam*State.H[k]
-            prob[l] = -0.5*torch.linalg.multi_dot([
-                u.t(),Sigma_U_inv[State.ind_theta_g[i]],
-                u])/s2[l]-0.5*(q+1)*torch.log(s2[l])+torch.log(State.p_g_lambda[l])
-        prob = torch.exp(prob-torch.max(prob))
-        for l in range(1,len(lambda_grid)):
-            prob[l] += prob[l-1]
-        prob = prob/prob[-1]
-        l_ind = ComputingUtils.draw_proportional(prob)
-        State.lambda_g[i] = lambda_grid[l_ind]
+    prob = GridUtils.lambda_log_prob(State.G, ComputingUtils.gather_units(State.H, State.K),
+                                     Sigma_U_inv[State.ind_theta_g],
+                                     State.kappa_g2*State.omega2.unsqueeze(1),
+                                     lambda_grid, State.p_g_lambda)
+    State.lambda_g = lambda_grid[ComputingUtils.draw_categorical(prob)]
+    Residuals.changed("lambda_g")
 
 def step6(lambda_grid: torch.Tensor): # p_c_lambda
     no_lambdas = len(lambda_grid)
-    a = torch.ones(no_lambdas).to(PreComputed.device)*20/no_lambdas
-    for i in range(n):
-        j = torch.round((no_lambdas-1)*State.lambda_c[i]/torch.max(lambda_grid)).int()
-        a[j] += 1
-    dist = torch.distributions.Chi2(a)
-    prob = dist.sample().to(PreComputed.device)
-    State.p_c_lambda = prob/prob.sum()
+    a = torch.ones((State.n_chains, no_lambdas)).to(PreComputed.device)*20/no_lambdas
+    j = torch.round((no_lambdas-1)*State.lambda_c/torch.max(lambda_grid)).long()
+    a.scatter_add_(1, j, torch.ones_like(State.lambda_c))
+    prob = ComputingUtils.draw_chi2(a)
+    State.p_c_lambda = prob/prob.sum(dim=1, keepdim=True)
 
 def step7(lambda_grid: torch.Tensor): # p_g_lambda
     no_lambdas = len(lambda_grid)
-    a = torch.ones(no_lambdas).to(PreComputed.device)*20/no_lambdas
-    for i in range(25):
-        j = torch.round((no_lambdas-1)*State.lambda_g[i]/torch.max(lambda_grid)).int()
-        a[j] += 1
-    dist = torch.distributions.Chi2(a)
-    prob = dist.sample().to(PreComputed.device)
-    State.p_g_lambda = prob/prob.sum()
+    a = torch.ones((State.n_chains, no_lambdas)).to(PreComputed.device)*20/no_lambdas
+    j = torch.round((no_lambdas-1)*State.lambda_g/torch.max(lambda_grid)).long()
+    a.scatter_add_(1, j, torch.ones_like(State.lambda_g))
+    prob = ComputingUtils.draw_chi2(a)
+    State.p_g_lambda = prob/prob.sum(dim=1, keepdim=True)
 
 def step8(Sigma_U_inv: torch.Tensor,
           kappa_grid: torch.Tensor): # kappa_c
-    prob = torch.zeros(len(kappa_grid)).to(PreComputed.device)
-    pbase = torch.zeros(len(kappa_grid)).to(PreComputed.device)
-    for l, kappa in enumerate(kappa_grid):
-        pbase[l] = -0.5*(q+1)*torch.log(kappa)+torch.log(State.p_c_kappa[l])
-    
-    s2 = State.omega2*(1-State.lambda_c**2)
-    for ind, i in enumerate(State.J):
-        u = State.C[ind]-State.lambda_c[ind]*State.G[i]
-        u[0] -= State.mu_c
-        usu = torch.linalg.multi_dot([u.t(), Sigma_U_inv[State.ind_theta_c[ind]], u])
-        prob = usu/(s2[ind]*kappa_grid)
-        prob += pbase
-        prob = torch.exp(prob-torch.max(prob))
-        for l in range(1,len(kappa_grid)):
-            prob[l] += prob[l-1]
-        prob = prob/prob[-1]
-        k_ind = ComputingUtils.draw_proportional(prob)
-        State.kappa_c2[ind] = kappa_grid[k_ind]
-        
+    _, usu = Residuals.quad("c", Sigma_U_inv)
+    s2 = State.omega2.unsqueeze(1)*(1-State.lambda_c**2)
+    prob = GridUtils.kappa_log_prob(usu, q+1, s2, kappa_grid, State.p_c_kappa)
+    State.kappa_c2 = kappa_grid[ComputingUtils.draw_categorical(prob)]
+
 def step9(Sigma_U_inv: torch.Tensor,
           kappa_grid: torch.Tensor): # kappa_g
-    prob = torch.zeros(len(kappa_grid)).to(PreComputed.device)
-    pbase = torch.zeros(len(kappa_grid)).to(PreComputed.device)
-    for l, kappa in enumerate(kappa_grid):
-        pbase[l] = -0.5*(q+1)*torch.log(kappa)+torch.log(State.p_g_kappa[l])
-    
-    s2 = State.omega2*(1-State.lambda_g**2)
-    for i,k in enumerate(State.K):
-        u = State.G[i]-State.lambda_g[i]*State.H[k]
-        usu = torch.linalg.multi_dot([u.t(), Sigma_U_inv[State.ind_theta_g[i]], u])
-        prob = usu/(s2[i]*kappa_grid)
-        prob += pbase
-        prob = torch.exp(prob-torch.max(prob))
-        for l in range(1,len(kappa_grid)):
-            prob[l] += prob[l-1]
-        prob = prob/prob[-1]
-        k_ind = ComputingUtils.draw_proportional(prob)
-        State.kappa_g2[i] = kappa_grid[k_ind]
+    _, usu = Residuals.quad("g", Sigma_U_inv)
+    s2 = State.omega2.unsqueeze(1)*(1-State.lambda_g**2)
+    prob = GridUtils.kappa_log_prob(usu, q+1, s2, kappa_grid, State.p_g_kappa)
+    State.kappa_g2 = kappa_grid[ComputingUtils.draw_categorical(prob)]
 
 def step10(Sigma_U_inv: torch.Tensor,
           kappa_grid: torch.Tensor): # kappa_h
-    prob = torch.zeros(len(kappa_grid)).to(PreComputed.device)
-    pbase = torch.zeros(len(kappa_grid)).to(PreComputed.device)
-    for l, kappa in enumerate(kappa_grid):
-        pbase[l] = -0.5*(q+1)*torch.log(kappa)+torch.log(State.p_h_kappa[l])
-    
-    s2 = State.omega2
-    for k, u in enumerate(State.H):
-        usu = torch.linalg.multi_dot([u.t(), Sigma_U_inv[State.ind_theta_h[k]], u])
-        prob = usu/(s2*kappa_grid)
-        prob += pbase
-        prob = torch.exp(prob-torch.max(prob))
-        for l in range(1,len(kappa_grid)):
-            prob[l] += prob[l-1]
-        prob = prob/prob[-1]
-        k_ind = ComputingUtils.draw_proportional(prob)
-        State.kappa_h2[k] = kappa_grid[k_ind]
+    _, usu = Residuals.quad("h", Sigma_U_inv)
+    s2 = State.omega2.unsqueeze(1)*torch.ones(State.H.shape[:2]).to(PreComputed.device)
+    prob = GridUtils.kappa_log_prob(usu, q+1, s2, kappa_grid, State.p_h_kappa)
+    State.kappa_h2 = kappa_grid[ComputingUtils.draw_categorical(prob)]
 
 def step11(kappa_grid: torch.Tensor): # p_c_kappa
     no_kappas = len(kappa_grid)
-    a = torch.ones(no_kappas).to(PreComputed.device)*20/no_kappas
-    for kappa in State.kappa_c2:
-        cond = kappa >= kappa_grid
-        ind = cond.sum()
-        a[ind] += 1
-    dist = torch.distributions.Chi2(a)
-    prob = dist.sample().to(PreComputed.device)
-    State.p_c_kappa = prob/prob.sum()
+    a = torch.ones((State.n_chains, no_kappas)).to(PreComputed.device)*20/no_kappas
+    cond = State.kappa_c2.unsqueeze(2) >= kappa_grid
+    ind = torch.clamp(cond.sum(dim=2), max=no_kappas-1)
+    a.scatter_add_(1, ind, torch.ones_like(State.kappa_c2))
+    prob = ComputingUtils.draw_chi2(a)
+    State.p_c_kappa = prob/prob.sum(dim=1, keepdim=True)
 
 def step12(kappa_grid: torch.Tensor): # p_g_kappa
     no_kappas = len(kappa_grid)
-    a = torch.ones(no_kappas).to(PreComputed.device)*20/no_kappas
-    for kappa in State.kappa_g2:
-        cond = kappa >= kappa_grid
-        ind = cond.sum()
-        a[ind] += 1
-    dist = torch.distributions.Chi2(a)
-    prob = dist.sample().to(PreComputed.device)
-    State.p_g_kappa = prob/prob.sum()
+    a = torch.ones((State.n_chains, no_kappas)).to(PreComputed.device)*20/no_kappas
+    cond = State.kappa_g2.unsqueeze(2) >= kappa_grid
+    ind = torch.clamp(cond.sum(dim=2), max=no_kappas-1)
+    a.scatter_add_(1, ind, torch.ones_like(State.kappa_g2))
+    prob = ComputingUtils.draw_chi2(a)
+    State.p_g_kappa = prob/prob.sum(dim=1, keepdim=True)
 
 def step13(kappa_grid: torch.Tensor): # p_h_kappa
     no_kappas = len(kappa_grid)
-    a = torch.ones(no_kappas).to(PreComputed.device)*20/no_kappas
-    for kappa in State.kappa_h2:
-        cond = kappa >= kappa_grid
-        ind = cond.sum()
-        a[ind] += 1
-    dist = torch.distributions.Chi2(a)
-    prob = dist.sample().to(PreComputed.device)
-    State.p_h_kappa = prob/prob.sum()
-
-def step14(Sigma_U_inv: torch.Tensor): # K
-    prob = torch.zeros(10).to(PreComputed.device)
-    s2 = (1-State.lambda_g**2)*State.kappa_g2*State.omega2
-    for i,v in enumerate(State.G):
-        for k,h in enumerate(State.H):
-            u=v-State.lambda_g[i]*h
-            prob[k] = -0.5*torch.linalg.multi_dot(
-                [u.t(),Sigma_U_inv[State.ind_theta_g[i]],u])/s2[i]
-        prob = torch.exp(prob-torch.max(prob))
-        for k in range(1,10):
-            prob[k] += prob[k-1]
-        prob = prob/prob[-1]
-        State.K[i] = ComputingUtils.draw_proportional(prob)
-
-def step15(Sigma_U_inv: torch.Tensor): # J
-    prob = torch.zeros(25).to(PreComputed.device)
-    s2 = (1-State.lambda_c**2)*State.kappa_c2*State.omega2
-    for ind in range(n):
-        v = State.C[ind]
-        v[0] -= State.mu_c
-        for k,g in enumerate(State.G):
-            u=v-State.lambda_c[ind]*g
-            prob[k] = -0.5*torch.linalg.multi_dot(
-                [u.t(),Sigma_U_inv[State.ind_theta_c[ind]],u])/s2[ind]
-        prob = torch.exp(prob-torch.max(prob))
-        for i in range(1,25):
-            prob[i] += prob[k-1]
-        prob = prob/prob[-1]
-        State.J[ind] = ComputingUtils.draw_proportional(prob)
+    a = torch.ones((State.n_chains, no_kappas)).to(PreComputed.device)*20/no_kappas
+    cond = State.kappa_h2.unsqueeze(2) >= kappa_grid
+    ind = torch.clamp(cond.sum(dim=2), max=no_kappas-1)
+    a.scatter_add_(1, ind, torch.ones_like(State.kappa_h2))
+    prob = ComputingUtils.draw_chi2(a)
+    State.p_h_kappa = prob/prob.sum(dim=1, keepdim=True)
+
+def step14(Chol_Sigma_U: torch.Tensor): # K
+    s2 = (1-State.lambda_g**2)*State.kappa_g2*State.omega2.unsqueeze(1)
+    usu = ComputingUtils.assignment_quad_forms(State.G, State.lambda_g, State.H,
+                                               Chol_Sigma_U[State.ind_theta_g])
+    State.K = ComputingUtils.draw_categorical(-0.5*usu/s2.unsqueeze(2))
+    Residuals.changed("K")
+
+def step15(Chol_Sigma_U: torch.Tensor): # J
+    s2 = (1-State.lambda_c**2)*State.kappa_c2*State.omega2.unsqueeze(1)
+    v = State.C.clone()
+    v[:, :, 0] -= State.mu_c.unsqueeze(1)
+    usu = ComputingUtils.assignment_quad_forms(v, State.lambda_c, State.G,
+                                               Chol_Sigma_U[State.ind_theta_c])
+    State.J = ComputingUtils.draw_categorical(-0.5*usu/s2.unsqueeze(2))
+    Residuals.changed("J")
 
 def step16(Sigma_U_inv: torch.Tensor,
            Det_Sigma_U: torch.Tensor): # ind_theta_c
-    meas = torch.zeros((n,q+1)).to(PreComputed.device)
-    s2 = (1-State.lambda_c**2)*State.kappa_c2*State.omega2
-    for ind,i in enumerate(State.J):
-        meas[ind] = State.C[ind]-State.lambda_c[ind]*State.G[i]
-        meas[ind][0] -= State.mu_c
-    State.ind_theta_c = ComputingUtils.draw_index(meas, State.p_c_theta, s2, Sigma_U_inv, Det_Sigma_U)
+    s2 = (1-State.lambda_c**2)*State.kappa_c2*State.omega2.unsqueeze(1)
+    State.ind_theta_c = ComputingUtils.draw_index(Residuals.residual("c"), State.p_c_theta, s2, Sigma_U_inv, Det_Sigma_U)
+    Residuals.changed("ind_theta_c")
 
 def step17(Sigma_U_inv: torch.Tensor,
            Det_Sigma_U: torch.Tensor): # ind_theta_g
-    meas = torch.zeros((25,q+1)).to(PreComputed.device)
-    s2 = (1-State.lambda_g**2)*State.kappa_g2*State.omega2
-    for i,k in enumerate(State.K):
-        meas[i] = State.G[i]-State.lambda_g[i]*State.H[k]
-    State.ind_theta_g = ComputingUtils.draw_index(meas, State.p_g_theta, s2, Sigma_U_inv, Det_Sigma_U)
+    s2 = (1-State.lambda_g**2)*State.kappa_g2*State.omega2.unsqueeze(1)
+    State.ind_theta_g = ComputingUtils.draw_index(Residuals.residual("g"), State.p_g_theta, s2, Sigma_U_inv, Det_Sigma_U)
+    Residuals.changed("ind_theta_g")
 
 def step18(Sigma_U_inv: torch.Tensor,
            Det_Sigma_U: torch.Tensor): # ind_theta_h
-    meas = torch.zeros((10,q+1)).to(PreComputed.device)
-    s2 = State.kappa_h2*State.omega2
-    for i,h in enumerate(State.H):
-        meas[i] = h
-    State.ind_theta_h = ComputingUtils.draw_index(meas, State.p_h_theta, s2, Sigma_U_inv, Det_Sigma_U)
+    s2 = State.kappa_h2*State.omega2.unsqueeze(1)
+    State.ind_theta_h = ComputingUtils.draw_index(State.H, State.p_h_theta, s2, Sigma_U_inv, Det_Sigma_U)
+    Residuals.changed("ind_theta_h")
 
 def step19(no_thetas: int): # p_c_theta
-    a = torch.ones(no_thetas).to(PreComputed.device)*20/no_thetas
-    for x in State.ind_theta_c:
-        a[x] += 1
-    dist = torch.distributions.Chi2(a)
-    prob = dist.sample().to(PreComputed.device)
-    State.p_c_theta = prob/prob.sum()
+    a = torch.ones((State.n_chains, no_thetas)).to(PreComputed.device)*20/no_thetas
+    a.scatter_add_(1, State.ind_theta_c, torch.ones_like(State.kappa_c2))
+    prob = ComputingUtils.draw_chi2(a)
+    State.p_c_theta = prob/prob.sum(dim=1, keepdim=True)
 
 def step20(no_thetas: int): # p_g_theta
-    a = torch.ones(no_thetas).to(PreComputed.device)*20/no_thetas
-    for x in State.ind_theta_g:
-        a[x] += 1
-    dist = torch.distributions.Chi2(a)
-    prob = dist.sample().to(PreComputed.device)
-    State.p_g_theta = prob/prob.sum()
+    a = torch.ones((State.n_chains, no_thetas)).to(PreComputed.device)*20/no_thetas
+    a.scatter_add_(1, State.ind_theta_g, torch.ones_like(State.kappa_g2))
+    prob = ComputingUtils.draw_chi2(a)
+    State.p_g_theta = prob/prob.sum(dim=1, keepdim=True)
 
 def step21(no_thetas: int): # p_h_theta
-    a = torch.ones(no_thetas).to(PreComputed.device)*20/no_thetas
-    for x in State.ind_theta_h:
-        a[x] += 1
-    dist = torch.distributions.Chi2(a)
-    prob = dist.sample().to(PreComputed.device)
-    State.p_h_theta = prob/prob.sum()
+    a = torch.ones((State.n_chains, no_thetas)).to(PreComputed.device)*20/no_thetas
+    a.scatter_add_(1, State.ind_theta_h, torch.ones_like(State.kappa_h2))
+    prob = ComputingUtils.draw_chi2(a)
+    State.p_h_theta = prob/prob.sum(dim=1, keepdim=True)
 
 def step22(Sigma_U_inv: torch.Tensor): # mu_c
-    m = 0
-    prec = 0
-    s2 = State.omega2*(1-State.lambda_c**2)*State.kappa_c2
-    i_1 = torch.zeros(q+1).to(PreComputed.device)
-    i_1[0] = 1
-    for ind, i in enumerate(State.J):
-        u = State.C[ind]-State.lambda_c[ind]*State.G[i]
-        m += torch.sum(Sigma_U_inv[State.ind_theta_c[ind], :, 0]*u)/s2[ind]
-        prec += Sigma_U_inv[State.ind_theta_c[ind], 0, 0]/s2[ind]
-    v = ComputingUtils.draw_standard_normal(1)
-    v = m/prec+v/torch.sqrt(prec)
-    State.mu_c = v[0]
+    s2 = State.omega2.unsqueeze(1)*(1-State.lambda_c**2)*State.kappa_c2
+    Su, _ = Residuals.quad("c", Sigma_U_inv)
+    # The cached residual already subtracts mu_c*e0, so it is added back through the first column
+    S0 = Sigma_U_inv[:, :, 0][State.ind_theta_c]
+    m = torch.sum((Su[:, :, 0]+State.mu_c.unsqueeze(1)*S0[:, :, 0])/s2, dim=1)
+    prec = torch.sum(S0[:, :, 0]/s2, dim=1)
+    v = ComputingUtils.draw_standard_normal()
+    mu_c = m/prec+v/torch.sqrt(prec)
+    Residuals.shift_mu_c(mu_c-State.mu_c, S0)
+    State.mu_c = mu_c
 
 def step23(Sigma_U_inv: torch.Tensor): # omega2
-    ssum = 1/2.198
-    snu = 1
-    s2 = State.kappa_c2*(1-State.lambda_c**2)
-    for ind, i in enumerate(State.J):
-        u = State.C[ind]-State.lambda_c[ind]*State.G[i]
-        u[0] -= State.mu_c
-        ssum += torch.linalg.multi_dot(
-            [u.t(), Sigma_U_inv[State.ind_theta_c[ind]], u])/s2[ind]
-        snu += q+1
-    s2 = State.kappa_g2*(1-State.lambda_g**2)
-    for i,k in enumerate(State.K):
-        u = State.G[i]-State.lambda_g[i]*State.H[k]
-        ssum += torch.linalg.multi_dot([
-            u.t(), Sigma_U_inv[State.ind_theta_g[i]], u])/s2[i]
-        snu += q+1
-    s2 = State.kappa_h2
-    for k, h in enumerate(State.H):
-        ssum += torch.linalg.multi_dot([
-            h.t(), Sigma_U_inv[State.ind_theta_h[k]], h])/s2[k]
-        snu += q+1
-    dist = torch.distributions.Chi2(snu)
-    v = dist.sample().to(PreComputed.device)
+    ssum = torch.ones(State.n_chains).to(PreComputed.device)/2.198
+    ssum += torch.sum(Residuals.quad("c", Sigma_U_inv)[1]/(State.kappa_c2*(1-State.lambda_c**2)), dim=1)
+    ssum += torch.sum(Residuals.quad("g", Sigma_U_inv)[1]/(State.kappa_g2*(1-State.lambda_g**2)), dim=1)
+    ssum += torch.sum(Residuals.quad("h", Sigma_U_inv)[1]/State.kappa_h2, dim=1)
+    snu = 1+(q+1)*(n+State.G.shape[1]+State.H.shape[1])
+    v = ComputingUtils.draw_chi2(snu*torch.ones(State.n_chains))
     State.omega2 = ssum/v
 
 def step24(Sigma_m: torch.Tensor,
            Sigma_A: torch.Tensor): # f0, mu_m
-    Sigma_F = State.sigma_m2*Sigma_m[State.ind_rho]+State.sigma_Da2*Sigma_A
+    Sigma_F = State.sigma_m2.view(-1, 1, 1)*Sigma_m[State.ind_rho]+State.sigma_Da2.view(-1, 1, 1)*Sigma_A
     Sigma_F_inv = torch.linalg.inv(Sigma_F)
 
-    prec = Sigma_F_inv[:2,:2]
-    m = torch.matmul(Sigma_F_inv[:2], State.F)
+    prec = Sigma_F_inv[:, :2, :2]
+    m = ComputingUtils.matvec(Sigma_F_inv[:, :2], State.F)
     prec = torch.linalg.inv(prec)
     v = ComputingUtils.draw_standard_normal(2)
-    v = torch.matmul(prec,m)+torch.matmul(
+    v = ComputingUtils.matvec(prec, m)+ComputingUtils.matvec(
         torch.linalg.cholesky(prec), v)
-    State.f0 = v[0]
-    State.mu_m = v[1]
+    State.f0 = v[:, 0]
+    State.mu_m = v[:, 1]
 
 def step25(Sigma_m: torch.Tensor,
            Sigma_A: torch.Tensor,
            Sigma_U_inv: torch.Tensor,
            weights: torch.Tensor,
            Deltainv: torch.Tensor): # F
-    m = torch.zeros(q+1).to(PreComputed.device)
-    fhat = torch.zeros(q+1).to(PreComputed.device)
-    # Sigma_F = State.sigma_m2*Sigma_m[State.ind_rho]+State.sigma_Da2*Sigma_A
-
-    # s2 = State.omega2*State.kappa_c2*(1-State.lambda_c**2)
-    # for ind, i in enumerate(State.J):
-    #     u = State.X[ind] - State.lambda_c[ind]*State.G[i]
-    #     u[0] -= State.mu_c
-    #     u[0] -= State.f0
-    #     u[1] -= State.mu_m
-    #     m += torch.matmul(Sigma_U_inv[State.ind_theta_c[ind]], u)/s2[ind]
-    #     Sigma_F += Sigma_U_inv[State.ind_theta_c[ind]]/s2[ind]
-    #     if weights[ind] > 0:
-    #         fhat += weights[ind]*State.X[ind]
-    # Sigma_F_inv = torch.linalg.inv(Sigma_F)
-    # V_F = torch.linalg.inv(Sigma_F_inv+Deltainv)
-    # fhat[0] -= State.f0
-    # fhat[1] -= State.mu_m
-    # m += torch.matmul(Deltainv, fhat-State.Y0)
-    # v = ComputingUtils.draw_standard_normal(q+1)
-    # State.F = torch.matmul(V_F, m)+torch.matmul(
-    #     torch.linalg.cholesky(V_F), v)
-    # State.F[0] += State.f0
-    # State.F[1] += State.mu_m
-    # for ind in range(n):
-    #     State.C[ind] = State.X[ind]-State.F
-    Sigi = State.sigma_m2*Sigma_m[State.ind_rho]+State.sigma_Da2*Sigma_A
+    m = torch.zeros((State.n_chains, q+1)).to(PreComputed.device)
+    fhat = torch.zeros((State.n_chains, q+1)).to(PreComputed.device)
+    Sigi = State.sigma_m2.view(-1, 1, 1)*Sigma_m[State.ind_rho]+State.sigma_Da2.view(-1, 1, 1)*Sigma_A
     Sigi = torch.linalg.inv(Sigi)
-    s2 = State.omega2*State.kappa_c2*(1-State.lambda_c**2)
-    for ind, i in enumerate(State.J):
-        u = State.X[ind]-State.lambda_c[ind]*State.G[i]
-        u[0] -= State.mu_c
-        u[0] -= State.f0
-        u[1] -= State.mu_m
-        m += torch.matmul(Sigma_U_inv[State.ind_theta_c[ind]],u)/s2[ind]
-        Sigi += Sigma_U_inv[State.ind_theta_c[ind]]/s2[ind]
+    s2 = State.omega2.unsqueeze(1)*State.kappa_c2*(1-State.lambda_c**2)
+    G_J = ComputingUtils.gather_units(State.G, State.J)
+    for ind in range(n):
+        u = State.X[:, ind]-State.lambda_c[:, ind].unsqueeze(1)*G_J[:, ind]
+        u[:, 0] -= State.mu_c
+        u[:, 0] -= State.f0
+        u[:, 1] -= State.mu_m
+        S = Sigma_U_inv[State.ind_theta_c[:, ind]]/s2[:, ind].view(-1, 1, 1)
+        m += ComputingUtils.matvec(S, u)
+        Sigi += S
         if weights[ind] > 0:
-            fhat += weights[ind]*State.X[ind]
+            fhat += weights[ind]*State.X[:, ind]
     Sigi += Deltainv
-    fhat[0] -= State.f0
-    fhat[1] -= State.mu_m
-    m += torch.matmul(Deltainv, fhat-State.Y0)
+    fhat[:, 0] -= State.f0
+    fhat[:, 1] -= State.mu_m
+    m += ComputingUtils.matvec(Deltainv, fhat-State.Y0)
     Sigi = torch.linalg.inv(Sigi)
     v = ComputingUtils.draw_standard_normal(q+1)
-    State.F = torch.matmul(Sigi,m)+torch.matmul(torch.linalg.cholesky(Sigi),v)
-    State.F[0] += State.f0
-    State.F[1] += State.mu_m
-    for ind in range(n):
-        State.C[ind] = State.X[ind]-State.F
+    State.F = ComputingUtils.matvec(Sigi, m)+ComputingUtils.matvec(torch.linalg.cholesky(Sigi), v)
+    State.F[:, 0] += State.f0
+    State.F[:, 1] += State.mu_m
+    State.C = State.X-State.F.unsqueeze(1)
+    Residuals.changed("C")
 
 def step26(Sigma_m: torch.Tensor,
            Sigma_A: torch.Tensor): # S_m
-    # Sig_m = State.sigma_m2*Sigma_m[State.ind_rho]
-    # Sigma_S = Sig_m+State.sigma_Da2*Sigma_A
-    # u = State.F
-    # u[0] -= State.f0
-    # u[1] -= State.mu_m
-    # mfm = torch.matmul(Sig_m, torch.linalg.inv(Sigma_S))
-    # v = ComputingUtils.draw_standard_normal(q+1)
-    # State.S_m = torch.matmul(mfm,u)+torch.matmul(
-    #     torch.linalg.cholesky(Sig_m-torch.matmul(mfm,Sig_m)), v)
-    S = State.sigma_m2*Sigma_m[State.ind_rho]
-    Sigi = S+State.sigma_Da2*Sigma_A
+    S = State.sigma_m2.view(-1, 1, 1)*Sigma_m[State.ind_rho]
+    Sigi = S+State.sigma_Da2.view(-1, 1, 1)*Sigma_A
     Sigi = torch.linalg.inv(Sigi)
-    u = State.F
-    u[0] -= State.f0
-    u[1] -= State.mu_m
+    u = State.F.clone()
+    u[:, 0] -= State.f0
+    u[:, 1] -= State.mu_m
     mfm = torch.matmul(S, Sigi)
     v = ComputingUtils.draw_standard_normal(q+1)
-    State.S_m = torch.matmul(mfm,u)+torch.matmul(torch.linalg.cholesky(S-torch.matmul(mfm,S)),v)
-    
+    State.S_m = ComputingUtils.matvec(mfm,u)+ComputingUtils.matvec(
+        torch.linalg.cholesky(S-torch.matmul(mfm,S)),v)
+
 def step27(sigma_grid: torch.Tensor,
            Sigma_m_inv: torch.Tensor,
            Sigma_A_inv: torch.Tensor): # sigma_m2, sigma_Da2
     no_sigmas = len(sigma_grid)
-    prob = torch.zeros(no_sigmas).to(PreComputed.device)
-    usu = torch.linalg.multi_dot(
-        [State.S_m.t(), Sigma_m_inv[State.ind_rho], State.S_m])
-    for l, sigma in enumerate(sigma_grid):
-        prob[l] = -0.5*usu/sigma-0.5*(q+1)*torch.log(sigma)
-    prob = torch.exp(prob-torch.max(prob))
-    for l in range(no_sigmas):
-        if 2*(l+1) <= no_sigmas:
-            prob[l] = prob[l]*(l+1)
-        else:
-            prob[l] = prob[l]*(no_sigmas-l)
-    for l in range(1, no_sigmas):
-        prob[l] += prob[l-1]
-    prob = prob/prob[-1]
-    s_ind = ComputingUtils.draw_proportional(prob)
+    usu = ComputingUtils.unit_quad_forms(State.S_m, State.S_m, Sigma_m_inv[State.ind_rho])
+    l = torch.arange(no_sigmas).to(PreComputed.device)
+    prior = torch.minimum(l+1, no_sigmas-l)
+    prob = -0.5*usu.unsqueeze(1)/sigma_grid-0.5*(q+1)*torch.log(sigma_grid)+torch.log(prior)
+    s_ind = ComputingUtils.draw_categorical(prob)
     State.sigma_m2 = sigma_grid[s_ind]
 
     u = State.F-State.S_m
-    u[0] -= State.f0
-    u[1] -= State.mu_m
-    ssum = 0.03**2/2.198+torch.linalg.multi_dot(
-        [u.t(), Sigma_A_inv, u])
+    u[:, 0] -= State.f0
+    u[:, 1] -= State.mu_m
+    ssum = 0.03**2/2.198+ComputingUtils.unit_quad_forms(u, u, Sigma_A_inv)
     snu = q+2
-    dist = torch.distributions.Chi2(snu)
-    v = dist.sample()
+    v = ComputingUtils.draw_chi2(snu*torch.ones(State.n_chains))
     State.sigma_Da2 = ssum/v
 
 def step28(Sigma_m_inv: torch.Tensor,
            Det_Sigma_m: torch.Tensor,
            rho_grid: torch.Tensor): #ind_rho
-    no_rhos = len(rho_grid)
-    u = State.S_m
-    prob = torch.zeros(no_rhos).to(PreComputed.device)
-    for i in range(no_rhos):
-        expon = -0.5/State.sigma_m2*torch.linalg.multi_dot(
-            [u.t(),Sigma_m_inv[i], u])+Det_Sigma_m[i]
-        prob[i] = torch.exp(expon)
-    for i in range(1,no_rhos):
-        prob[i] += prob[i-1]
-    prob = prob/prob[-1]
-    State.ind_rho = ComputingUtils.draw_proportional(prob)
\ No newline at end of file
+    usu = ComputingUtils.quad_forms(State.S_m, Sigma_m_inv)
+    prob = -0.5/State.sigma_m2.unsqueeze(1)*usu+Det_Sigma_m
+    State.ind_rho = ComputingUtils.draw_categorical(prob)
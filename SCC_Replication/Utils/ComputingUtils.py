@@ -1,60 +1,125 @@
+import math
 import torch
 import Variables.PreComputed as PreComputed
+import Variables.State as State
 
-def draw_standard_normal(n: int):
-    dist = torch.distributions.MultivariateNormal(torch.zeros(n), torch.eye(n))
-    return dist.sample().to(PreComputed.device)
+def chain_generators(seeds: list[int]):
+    generators = []
+    for seed in seeds:
+        g = torch.Generator()
+        g.manual_seed(int(seed))
+        generators.append(g)
+    return generators
 
-def draw_proportional(prob: torch.tensor):
-    unif = torch.rand(1).to(PreComputed.device)
-    cond = unif>prob
-    return min(cond.sum(),len(prob)-1)
+# Pre-drawn (chains x block) variates; draws hand out views of the next unused values
+block_sizes = {"normal": 8192, "uniform": 2048}
+buffers = {"normal": None, "uniform": None}
+offsets = {"normal": 0, "uniform": 0}
+
+def reset_buffers():
+    for kind in buffers:
+        buffers[kind] = None
+        offsets[kind] = 0
+
+def refill_buffer(kind: str, needed: int):
+    # Keeps the unused tail and appends one new block per chain, each from the chain's own stream
+    size = max(block_sizes[kind], needed)
+    sample = torch.randn if kind == "normal" else torch.rand
+    block = torch.stack([sample(size, generator=g) for g in State.generators]).to(PreComputed.device)
+    if buffers[kind] is not None:
+        block = torch.cat([buffers[kind][:, offsets[kind]:], block], dim=1)
+    buffers[kind] = block
+    offsets[kind] = 0
+
+def take(kind: str, shape: tuple):
+    size = math.prod(shape)
+    if buffers[kind] is None or buffers[kind].shape[1]-offsets[kind] < size:
+        refill_buffer(kind, size)
+    start = offsets[kind]
+    offsets[kind] += size
+    return buffers[kind][:, start:start+size].view(-1, *shape)
+
+def draw_standard_normal(*shape: int):
+    return take("normal", shape)
+
+def draw_uniform(*shape: int):
+    return take("uniform", shape)
+
+def draw_chi2(df: torch.Tensor):
+    # df has a leading chain dimension; chi2(k) = 2*Gamma(k/2, 1)
+    df = df.cpu()
+    draws = [2*torch._standard_gamma(df[c]/2, generator=g) for c, g in enumerate(State.generators)]
+    return torch.stack(draws).to(PreComputed.device)
+
+def draw_categorical(log_prob: torch.Tensor, no_draws: int = None):
+    # Inverse-CDF draws from unnormalised log-weights along the last dimension
+    log_prob = log_prob-torch.logsumexp(log_prob, dim=-1, keepdim=True)
+    cdf = torch.cumsum(torch.exp(log_prob), dim=-1)
+    if no_draws is None:
+        unif = draw_uniform(*cdf.shape[1:-1]).unsqueeze(-1)
+    else:
+        cdf = cdf.unsqueeze(-2)
+        unif = draw_uniform(*cdf.shape[1:-2], no_draws, 1)
+    cond = unif>cdf
+    return torch.clamp(cond.sum(dim=-1), max=cdf.shape[-1]-1)
+
+def draw_from_precision(V: torch.Tensor, b: torch.Tensor):
+    # N(V^-1 b, V^-1) through the Cholesky factor of the precision V, batched over the leading dimensions
+    L = torch.linalg.cholesky(V)
+    z = draw_standard_normal(*b.shape[1:]).unsqueeze(-1)
+    mean = torch.cholesky_solve(b.unsqueeze(-1), L)
+    return (mean+torch.linalg.solve_triangular(L.transpose(-1, -2), z, upper=True)).squeeze(-1)
+
+def gather_units(x: torch.Tensor, ind: torch.Tensor):
+    # x[c, ind[c, i]] for every chain c and unit i
+    rows = torch.arange(x.shape[0]).to(ind.device).unsqueeze(1)
+    return x[rows, ind]
+
+def matvec(A: torch.Tensor, v: torch.Tensor):
+    return torch.matmul(A, v.unsqueeze(-1)).squeeze(-1)
+
+def unit_quad_forms(u: torch.Tensor, v: torch.Tensor, Sigma_inv: torch.Tensor):
+    # u_i' Sigma_inv[i] v_i for every unit i
+    return torch.sum(matvec(Sigma_inv, v)*u, dim=-1)
+
+def quad_forms(meas: torch.Tensor, Sigma_inv: torch.Tensor):
+    # u' Sigma_inv[j] u for every row u of meas and every matrix j
+    u = meas.reshape(-1, meas.shape[-1]).t()
+    usu = torch.sum(torch.matmul(Sigma_inv, u)*u, dim=-2).t()
+    return usu.reshape(meas.shape[:-1]+(len(Sigma_inv),))
+
+def assignment_quad_forms(v: torch.Tensor,
+                          lam: torch.Tensor,
+                          centres: torch.Tensor,
+                          Chol_Sigma: torch.Tensor):
+    # u' Sigma[i]^-1 u for u = v_i-lam_i*centres_k, as a (chains x units x clusters) tensor;
+    # with Sigma = L L', u' Sigma^-1 u = |L^-1 v_i-lam_i L^-1 centres_k|^2
+    a = torch.linalg.solve_triangular(Chol_Sigma, v.unsqueeze(-1), upper=False)
+    b = torch.linalg.solve_triangular(Chol_Sigma, centres.transpose(1, 2).unsqueeze(1), upper=False)
+    return torch.sum((a-lam.view(*lam.shape, 1, 1)*b)**2, dim=-2)
 
 def draw_index(meas: torch.Tensor,
                dist: torch.Tensor,
                s2: torch.Tensor,
                Sigma_U_inv: torch.Tensor,
                Det_Sigma_U: torch.Tensor):
-    prob = torch.zeros(len(dist)).to(PreComputed.device)
-    new_inds = torch.zeros(len(meas)).to(PreComputed.device)
-    for i,u in enumerate(meas):
-        for j, p in enumerate(dist):
-            prob[j] = -0.5*torch.sum(torch.matmul(
-                Sigma_U_inv[j],u)*u)/s2[i]+torch.log(p)+Det_Sigma_U[j]
-        prob = torch.exp(prob-torch.max(prob))
-        for j in range(1,len(dist)):
-            prob[j] += prob[j-1]
-        prob = prob/prob[-1]
-        ind = draw_proportional(prob)
-        new_inds[i] = ind
-    return new_inds.int()
-
-def decimal_representation(x: torch.Tensor):
-    if x == 0:
-        return 0
-    sign = -1 if x < 0 else 1
-    abs_x = torch.abs(x)
-    n = torch.floor(torch.log10(abs_x))
-    m = abs_x / 10 ** n
-    a = sign*m
-    b = n
-    return a,b
-
-def det(A: torch.Tensor):
-    n = A.shape[0]
-    base = torch.zeros(n).to(PreComputed.device)
-    exp = torch.zeros(n).to(PreComputed.device)
-    eigvals = torch.linalg.eigvals(A).real
-    for i, val in enumerate(eigvals):
-        a, b = decimal_representation(val)
-        base[i] = a
-        exp[i] = b
-    base = torch.prod(base)
-    exp = torch.sum(exp)
-    base_a, base_b = decimal_representation(base)
-    base = base_a
-    exp += base_b
-    return base, exp
+    prob = -0.5*quad_forms(meas, Sigma_U_inv)/s2.unsqueeze(-1)+torch.log(dist).unsqueeze(-2)+Det_Sigma_U
+    return draw_categorical(prob)
+
+def gelman_rubin(draws: torch.Tensor):
+    # Potential scale reduction factor of (draws, chains, ...) per element
+    draws = draws.double()
+    no_draws = draws.shape[0]
+    W = torch.var(draws, dim=0).mean(dim=0)
+    B = no_draws*torch.var(torch.mean(draws, dim=0), dim=0)
+    var_plus = (no_draws-1)/no_draws*W+B/no_draws
+    return torch.sqrt(var_plus/W)
+
+def spd_factor(S: torch.Tensor):
+    # Cholesky factor, inverse and -0.5*log|S| of a batch of SPD matrices
+    L = torch.linalg.cholesky(S)
+    neg_half_logdet = -torch.sum(torch.log(torch.diagonal(L, dim1=-2, dim2=-1)), dim=-1)
+    return L, torch.cholesky_inverse(L), neg_half_logdet
 
 def OLS(X: torch.Tensor, Y: torch.Tensor):
     xtx_inv = torch.linalg.inv(torch.matmul(X.t(), X))
@@ -1,4 +1,9 @@
+import bisect
 import csv
+import glob
+import os
+import shutil
+import numpy as np
 import torch
 
 def write_mat(mat, out):
@@ -39,6 +44,122 @@ def write_to_file(data, out):
         for d in data:
             write_mat(d, out)
 
+def segment_path(out, chain, segment):
+    return os.path.join(out, f"chain{chain}", f"{segment:05d}.npy")
+
+def write_segment(data, out, chain, segment):
+    # Written under a temporary name and renamed, so a crash never leaves a partial segment
+    path = segment_path(out, chain, segment)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path+'.tmp', mode='wb') as file:
+        np.save(file, data.numpy())
+    os.replace(path+'.tmp', path)
+
+class DrawReader:
+    """
+    Lazy, memory-mapped view over the .npy segments of one recorded
+    variable and chain. Indexed as (draw, unit, coefficient, ...);
+    only the selected draws are ever read from disk
+    """
+    def __init__(self, out, chain=0):
+        files = sorted(glob.glob(os.path.join(out, f"chain{chain}", "*.npy")))
+        if len(files) == 0:
+            raise FileNotFoundError(f"No draws stored under {out} for chain {chain}")
+        # Copy-on-write maps give writable arrays, so torch can share their memory
+        self.segments = [np.load(f, mmap_mode='c') for f in files]
+        self.offsets = [0]
+        for seg in self.segments:
+            self.offsets.append(self.offsets[-1]+len(seg))
+        self.shape = (self.offsets[-1],)+self.segments[0].shape[1:]
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        draws, rest = key[0], key[1:]
+        if isinstance(draws, slice):
+            return self.read(draws, rest)
+        draws = int(draws)
+        if draws < 0:
+            draws += len(self)
+        if draws < 0 or draws >= len(self):
+            raise IndexError(f"Draw {draws} out of range for {len(self)} draws")
+        s = bisect.bisect_right(self.offsets, draws)-1
+        return torch.from_numpy(np.asarray(self.segments[s][draws-self.offsets[s]][rest]))
+
+    def read(self, draws: slice, rest: tuple = ()):
+        start, stop, step = draws.indices(len(self))
+        if step < 0:
+            raise ValueError("Draw slices must have a positive step")
+        pieces = []
+        for seg, offset in zip(self.segments, self.offsets):
+            lo = max(start, offset)
+            lo += (start-lo)%step
+            hi = min(stop, offset+len(seg))
+            # rest indexes the unit/coefficient axes together with the draw slice
+            if lo < hi:
+                pieces.append(seg[(slice(lo-offset, hi-offset, step),)+rest])
+        if len(pieces) == 0:
+            return torch.from_numpy(np.asarray(self.segments[0][(slice(0, 0),)+rest]))
+        if len(pieces) == 1:
+            return torch.from_numpy(np.asarray(pieces[0]))
+        return torch.from_numpy(np.concatenate(pieces))
+
+    def blocks(self):
+        # One tensor per stored segment, for streaming post-processing
+        for seg in self.segments:
+            yield torch.from_numpy(np.asarray(seg))
+
+class ChainsReader:
+    """
+    Lazy view over the draws of several chains of one recorded
+    variable, stacked along a chain axis after the draws as in the
+    sampler's buffers. Indexed as (draw, chain, unit, coefficient,
+    ...); chains are cut to the draws they all have
+    """
+    def __init__(self, out, chains):
+        self.readers = [DrawReader(out, chain) for chain in chains]
+        self.shape = (min(len(r) for r in self.readers), len(self.readers))+self.readers[0].shape[1:]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        draws, chains, rest = key[0], key[1] if len(key) > 1 else slice(None), key[2:]
+        if isinstance(draws, slice):
+            draws = slice(*draws.indices(len(self)))
+        else:
+            draws = int(draws)
+            if draws < 0:
+                draws += len(self)
+            if draws < 0 or draws >= len(self):
+                raise IndexError(f"Draw {draws} out of range for {len(self)} draws")
+        picked = range(len(self.readers))[chains]
+        if isinstance(picked, int):
+            return self.readers[picked][(draws,)+rest]
+        return torch.stack([self.readers[c][(draws,)+rest] for c in picked], dim=1 if isinstance(draws, slice) else 0)
+
+def remove_segments(out, chain, first):
+    for f in glob.glob(os.path.join(out, f"chain{chain}", "*.npy")):
+        if int(os.path.basename(f)[:-4]) >= first:
+            os.remove(f)
+
+def write_torch(data, out):
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    torch.save(data, out+'.tmp')
+    os.replace(out+'.tmp', out)
+
+def read_torch(input):
+    # Loaded on the CPU: generator states must stay there
+    return torch.load(input, map_location='cpu')
+
+def clear_dir(out):
+    shutil.rmtree(out, ignore_errors=True)
+
 def clear_csv(out):
     with open(out, mode='w') as file:
         file.write('')
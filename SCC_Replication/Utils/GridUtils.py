@@ -0,0 +1,31 @@
+"""
+Batched discrete grid posteriors: every unit's log-probability over
+the grid is computed at once as a (chains x units x grid) tensor
+"""
+
+import torch
+import Utils.ComputingUtils as ComputingUtils
+
+
+def lambda_log_prob(v: torch.Tensor,
+                    g: torch.Tensor,
+                    Sigma_inv: torch.Tensor,
+                    scale: torch.Tensor,
+                    lambda_grid: torch.Tensor,
+                    p_lambda: torch.Tensor):
+    # u = v-lambda*g, so u'Su expands into three quadratic forms per unit
+    vSv = ComputingUtils.unit_quad_forms(v, v, Sigma_inv).unsqueeze(-1)
+    vSg = ComputingUtils.unit_quad_forms(v, g, Sigma_inv).unsqueeze(-1)
+    gSg = ComputingUtils.unit_quad_forms(g, g, Sigma_inv).unsqueeze(-1)
+    usu = vSv-2*lambda_grid*vSg+lambda_grid**2*gSg
+    s2 = (1-lambda_grid**2)*scale.unsqueeze(-1)
+    return -0.5*usu/s2-0.5*v.shape[-1]*torch.log(s2)+torch.log(p_lambda).unsqueeze(-2)
+
+def kappa_log_prob(usu: torch.Tensor,
+                   dim: int,
+                   s2: torch.Tensor,
+                   kappa_grid: torch.Tensor,
+                   p_kappa: torch.Tensor):
+    # usu holds each unit's u' Sigma_inv u, dim the length of u; kappa_grid holds kappa^2
+    pbase = -0.5*dim*torch.log(kappa_grid)+torch.log(p_kappa).unsqueeze(-2)
+    return -0.5*usu.unsqueeze(-1)/(s2.unsqueeze(-1)*kappa_grid)+pbase
@@ -0,0 +1,88 @@
+"""
+Online accumulators over a stream of equally shaped draws, updated
+element-wise in constant memory
+"""
+
+import torch
+
+
+class Welford:
+    """
+    Running mean and variance of every element
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x: torch.Tensor):
+        x = x.double()
+        if self.mean is None:
+            self.mean = torch.zeros_like(x)
+            self.m2 = torch.zeros_like(x)
+        self.count += 1
+        delta = x-self.mean
+        self.mean += delta/self.count
+        self.m2 += delta*(x-self.mean)
+
+    def variance(self):
+        if self.count < 2:
+            return torch.zeros_like(self.mean)
+        return self.m2/(self.count-1)
+
+class P2Quantiles:
+    """
+    P^2 quantile estimates (Jain and Chlamtac, 1985) of every element:
+    five markers per element and probability, whose middle marker
+    tracks the quantile. Estimates are indexed as (..., probability)
+    """
+    def __init__(self, probs: list[float]):
+        self.probs = torch.tensor(probs, dtype=torch.float64)
+        self.count = 0
+        self.heights = None
+        self.positions = None
+
+    def update(self, x: torch.Tensor):
+        x = x.double().unsqueeze(-1).expand(*x.shape, len(self.probs))
+        if self.count < 5:
+            # The first five draws initialise the markers
+            if self.heights is None:
+                self.heights = torch.zeros(x.shape+(5,), dtype=torch.float64, device=x.device)
+            self.heights[..., self.count] = x
+            self.count += 1
+            if self.count == 5:
+                self.heights = torch.sort(self.heights, dim=-1).values
+                self.positions = torch.arange(1, 6, dtype=torch.float64, device=x.device).expand_as(self.heights).clone()
+            return
+        self.count += 1
+        h = self.heights
+        pos = self.positions
+        h[..., 0] = torch.minimum(h[..., 0], x)
+        h[..., 4] = torch.maximum(h[..., 4], x)
+        k = torch.sum(x.unsqueeze(-1) >= h[..., 1:4], dim=-1, keepdim=True)
+        pos += (torch.arange(5, device=x.device) > k).double()
+
+        p = self.probs.to(x.device)
+        steps = torch.stack([torch.zeros_like(p), p/2, p, (1+p)/2, torch.ones_like(p)], dim=-1)
+        desired = 1+(self.count-1)*steps
+        for i in range(1, 4):
+            d = desired[..., i]-pos[..., i]
+            up = (d >= 1) & (pos[..., i+1]-pos[..., i] > 1)
+            down = (d <= -1) & (pos[..., i-1]-pos[..., i] < -1)
+            s = up.double()-down.double()
+            parabolic = h[..., i]+s/(pos[..., i+1]-pos[..., i-1])*(
+                (pos[..., i]-pos[..., i-1]+s)*(h[..., i+1]-h[..., i])/(pos[..., i+1]-pos[..., i])
+                +(pos[..., i+1]-pos[..., i]-s)*(h[..., i]-h[..., i-1])/(pos[..., i]-pos[..., i-1]))
+            h_next = torch.where(up, h[..., i+1], h[..., i-1])
+            pos_next = torch.where(up, pos[..., i+1], pos[..., i-1])
+            linear = h[..., i]+s*(h_next-h[..., i])/(pos_next-pos[..., i])
+            inside = (h[..., i-1] < parabolic) & (parabolic < h[..., i+1])
+            h[..., i] = torch.where(up | down, torch.where(inside, parabolic, linear), h[..., i])
+            pos[..., i] += s
+
+    def quantiles(self):
+        if self.count < 5:
+            # Exact quantiles of the few draws seen so far
+            q = torch.quantile(self.heights[..., 0, :self.count], self.probs.to(self.heights.device), dim=-1)
+            return q.movedim(0, -1)
+        return self.heights[..., 2].clone()
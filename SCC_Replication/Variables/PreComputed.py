@@ -19,6 +19,11 @@ no_lambdas = 25
 no_rhos = 25
 no_thetas = 100 
 no_sigmas = 25
+no_groups = 25
+no_supergroups = 10
+
+theta_seed = 0
+cache_dir = 'Results/Cache'
 
 lambda_grid = None
 kappa_grid = None
@@ -28,16 +33,35 @@ sigma_grid = None
 weights = None
 regions = []
 
+Sigma_U = None
 Sigma_U_inv = None
 Chol_Sigma_U = None
 Det_Sigma_U = None
 
-SuAA = None
-SuAAS = None
+# Low-rank factors of Sigma A (A'Sigma A)^-1 A' per (theta, missingness pattern),
+# zero-padded to the largest pattern rank; region_pattern maps countries to patterns.
+# ASA = A'Sigma A, so that Sigma A = SuA ASA
+SuA = None
+A = None
+ASA = None
+region_pattern = None
 
 Sigma_m = None
 Sigma_m_inv = None
 Det_Sigma_m = None
 
 Sigma_A = None
-Sigma_A_inv = None
\ No newline at end of file
+Sigma_A_inv = None
+
+# Forecasts of the 100 years after the sample: in-sample fit of the
+# coefficients (T x q+1), trend increments (100 x 2), and conditional
+# means and Cholesky factors of the increments given the coefficients
+# for S_m (per rho), the random walk part of F and U (per theta)
+fit_weights = None
+Xfcstf = None
+mfcstfm = None
+cholfcstfm = None
+mfcstfa = None
+cholfcstfa = None
+mfcstu = None
+cholfcstu = None
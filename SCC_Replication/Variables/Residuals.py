@@ -0,0 +1,69 @@
+"""
+Residuals of the country (c), group (g) and supergroup (h) levels
+and their quadratic forms against Sigma_U_inv[ind_theta], shared
+across the Gibbs steps. Entries are rebuilt lazily once a step
+reports that one of their inputs changed
+"""
+
+import torch
+import Utils.ComputingUtils as ComputingUtils
+import Variables.State as State
+
+# c: C-lambda_c*G[J]-mu_c*e0, g: G-lambda_g*H[K], h: H
+u = {"c": None, "g": None, "h": None}
+# Sigma_U_inv[ind_theta] u and u' Sigma_U_inv[ind_theta] u
+Su = {"c": None, "g": None, "h": None}
+usu = {"c": None, "g": None, "h": None}
+
+# State variables each level depends on:
+inputs = {
+    "c": ["C", "lambda_c", "G", "J", "mu_c"],
+    "g": ["G", "lambda_g", "H", "K"],
+    "h": ["H"]
+}
+thetas = {"c": "ind_theta_c", "g": "ind_theta_g", "h": "ind_theta_h"}
+
+def reset():
+    for level in u:
+        u[level] = None
+        Su[level] = None
+        usu[level] = None
+
+def changed(*names: str):
+    for level in u:
+        if any(name in inputs[level] for name in names):
+            u[level] = None
+            Su[level] = None
+            usu[level] = None
+        elif thetas[level] in names:
+            Su[level] = None
+            usu[level] = None
+
+def residual(level: str):
+    if u[level] is None:
+        if level == "c":
+            res = State.C-State.lambda_c.unsqueeze(2)*ComputingUtils.gather_units(State.G, State.J)
+            res[:, :, 0] -= State.mu_c.unsqueeze(1)
+        elif level == "g":
+            res = State.G-State.lambda_g.unsqueeze(2)*ComputingUtils.gather_units(State.H, State.K)
+        else:
+            res = State.H
+        u[level] = res
+    return u[level]
+
+def quad(level: str, Sigma_U_inv: torch.Tensor):
+    if usu[level] is None:
+        res = residual(level)
+        Su[level] = ComputingUtils.matvec(Sigma_U_inv[getattr(State, thetas[level])], res)
+        usu[level] = torch.sum(Su[level]*res, dim=-1)
+    return Su[level], usu[level]
+
+def shift_mu_c(delta: torch.Tensor, S0: torch.Tensor):
+    # mu_c += delta moves every country residual by -delta*e0; S0 = Sigma_U_inv[ind_theta_c][..., 0]
+    delta = delta.unsqueeze(1)
+    res = u["c"].clone()
+    res[:, :, 0] -= delta
+    u["c"] = res
+    if usu["c"] is not None:
+        usu["c"] = usu["c"]-2*delta*Su["c"][:, :, 0]+delta**2*S0[:, :, 0]
+        Su["c"] = Su["c"]-delta.unsqueeze(2)*S0
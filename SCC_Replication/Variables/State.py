@@ -1,7 +1,11 @@
 """
-Variables for the state of the Gibbs Sampler
+Variables for the state of the Gibbs Sampler. Every variable
+carries a leading dimension of size n_chains
 """
 
+n_chains = 1
+generators = []
+
 p_c_kappa = None
 p_g_kappa = None
 p_h_kappa = None
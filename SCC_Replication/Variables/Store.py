@@ -1,94 +1,183 @@
 """
-Variables for staring the results of each Gibbs draw
+Variables for staring the results of each Gibbs draw. Draws are
+copied into preallocated (flush_every x chains x ...) buffers and
+flushed to disk as one .npy segment per variable and chain. Which
+variables are kept, how often and at which precision is set by
+recorded
 """
 
+import torch
 import Utils.FileUtils as FileUtils
+import Utils.ComputingUtils as ComputingUtils
 
-# Lists:
-p_c_kappa_draws = []
-p_g_kappa_draws = []
-p_h_kappa_draws = []
+# Buffers, allocated on the first recorded draw:
+p_c_kappa_draws = None
+p_g_kappa_draws = None
+p_h_kappa_draws = None
 
-p_c_theta_draws = []
-p_g_theta_draws = []
-p_h_theta_draws = []
+p_c_theta_draws = None
+p_g_theta_draws = None
+p_h_theta_draws = None
 
-p_c_lambda_draws = []
-p_g_lambda_draws = []
+p_c_lambda_draws = None
+p_g_lambda_draws = None
 
-F_draws = []
-S_m_draws = []
-X_draws = []
-C_draws = []
+F_draws = None
+S_m_draws = None
+X_draws = None
+C_draws = None
 
-sigma_m2_draws = []
-sigma_Da2_draws = []
-ind_rho_draws = []
-mu_c_draws = []
-omega2_draws = []
-f0_draws = []
-mu_m_draws = []
+sigma_m2_draws = None
+sigma_Da2_draws = None
+ind_rho_draws = None
+mu_c_draws = None
+omega2_draws = None
+f0_draws = None
+mu_m_draws = None
 
-kappa_c2_draws = []
-kappa_g2_draws = []
-kappa_h2_draws = []
+kappa_c2_draws = None
+kappa_g2_draws = None
+kappa_h2_draws = None
 
-lambda_c_draws = []
-lambda_g_draws = []
+lambda_c_draws = None
+lambda_g_draws = None
 
-G_draws = []
-H_draws = []
-K_draws = []
-J_draws = []
+G_draws = None
+H_draws = None
+K_draws = None
+J_draws = None
 
-ind_theta_c_draws = []
-ind_theta_g_draws = []
-ind_theta_h_draws = []
+ind_theta_c_draws = None
+ind_theta_g_draws = None
+ind_theta_h_draws = None
 
-# Paths to csv files:
+flush_every = 10
+enabled = True
+chain_ids = [0]
+segment = 0
+count = 0 # Draws offered since the last flush
+kept = 0 # Draws offered since the start of the run
+counts = {} # Draws held in each buffer
+
+# Directories of the .npy segments:
 paths = {
-    "p_c_kappa_draws" : ["Results/Distributions/p_c_kappa.csv",True],
-    "p_g_kappa_draws" : ["Results/Distributions/p_g_kappa.csv",True],
-    "p_h_kappa_draws" : ["Results/Distributions/p_h_kappa.csv",True],
-    "p_c_theta_draws" : ["Results/Distributions/p_c_theta.csv",True],
-    "p_g_theta_draws" : ["Results/Distributions/p_g_theta.csv",True],
-    "p_h_theta_draws" : ["Results/Distributions/p_h_theta.csv",True],
-    "p_c_lambda_draws" : ["Results/Distributions/p_c_lambda.csv",True],
-    "p_g_lambda_draws" : ["Results/Distributions/p_g_lambda.csv",True],
-    "F_draws" : ["Results/F.csv",True],
-    "S_m_draws" : ["Results/S_m.csv",True],
-    "X_draws" : ["Results/X.csv",True],
-    "C_draws" : ["Results/C.csv",True],
-    "sigma_m2_draws" : ["Results/sigma_m2.csv",False],
-    "sigma_Da2_draws" : ["Results/sigma_Da2.csv",False],
-    "ind_rho_draws" : ["Results/ind_rho.csv",False],
-    "mu_c_draws" : ["Results/mu_c.csv",False],
-    "omega2_draws" : ["Results/omega2.csv",False],
-    "f0_draws" : ["Results/f0.csv",False],
-    "mu_m_draws" : ["Results/mu_m.csv",False],
-    "kappa_c2_draws" : ["Results/Kappas/kappa_c2.csv",True],
-    "kappa_g2_draws" : ["Results/Kappas/kappa_g2.csv",True],
-    "kappa_h2_draws" : ["Results/Kappas/kappa_h2.csv",True],
-    "lambda_c_draws" : ["Results/Lambdas/lambda_c.csv",True],
-    "lambda_g_draws" : ["Results/Lambdas/lambda_g.csv",True],
-    "G_draws" : ["Results/G.csv",True],
-    "H_draws" : ["Results/H.csv",True],
-    "K_draws" : ["Results/K.csv",True],
-    "J_draws" : ["Results/J.csv",True],
-    "ind_theta_c_draws" : ["Results/Thetas/theta_c.csv",True],
-    "ind_theta_g_draws" : ["Results/Thetas/theta_g.csv",True],
-    "ind_theta_h_draws" : ["Results/Thetas/theta_h.csv",True]
+    "p_c_kappa_draws" : "Results/Distributions/p_c_kappa",
+    "p_g_kappa_draws" : "Results/Distributions/p_g_kappa",
+    "p_h_kappa_draws" : "Results/Distributions/p_h_kappa",
+    "p_c_theta_draws" : "Results/Distributions/p_c_theta",
+    "p_g_theta_draws" : "Results/Distributions/p_g_theta",
+    "p_h_theta_draws" : "Results/Distributions/p_h_theta",
+    "p_c_lambda_draws" : "Results/Distributions/p_c_lambda",
+    "p_g_lambda_draws" : "Results/Distributions/p_g_lambda",
+    "F_draws" : "Results/F",
+    "S_m_draws" : "Results/S_m",
+    "X_draws" : "Results/X",
+    "C_draws" : "Results/C",
+    "sigma_m2_draws" : "Results/sigma_m2",
+    "sigma_Da2_draws" : "Results/sigma_Da2",
+    "ind_rho_draws" : "Results/ind_rho",
+    "mu_c_draws" : "Results/mu_c",
+    "omega2_draws" : "Results/omega2",
+    "f0_draws" : "Results/f0",
+    "mu_m_draws" : "Results/mu_m",
+    "kappa_c2_draws" : "Results/Kappas/kappa_c2",
+    "kappa_g2_draws" : "Results/Kappas/kappa_g2",
+    "kappa_h2_draws" : "Results/Kappas/kappa_h2",
+    "lambda_c_draws" : "Results/Lambdas/lambda_c",
+    "lambda_g_draws" : "Results/Lambdas/lambda_g",
+    "G_draws" : "Results/G",
+    "H_draws" : "Results/H",
+    "K_draws" : "Results/K",
+    "J_draws" : "Results/J",
+    "ind_theta_c_draws" : "Results/Thetas/theta_c",
+    "ind_theta_g_draws" : "Results/Thetas/theta_g",
+    "ind_theta_h_draws" : "Results/Thetas/theta_h"
 }
 
+# Recording spec: variable -> (thinning interval, dtype). Only listed variables
+# are stored; a dtype of None keeps the state's precision. Index variables
+# always keep their integer dtype
+recorded = {var: (1, None) for var in paths}
+
 def clear_files():
     for path in paths.values():
-        FileUtils.clear_csv(path[0])
+        FileUtils.clear_dir(path)
     FileUtils.clear_csv('Results/Thetas/theta.csv')
 
+def reset(chains: list[int] = None):
+    # chains: the chain ids under which the local chains are written
+    global chain_ids, segment, count, kept
+    chain_ids = [0] if chains is None else chains
+    segment = 0
+    count = 0
+    kept = 0
+    for var in paths:
+        globals()[var] = None
+        counts[var] = 0
+
+def allocate(var: str, val: torch.Tensor):
+    thin, dtype = recorded[var]
+    if dtype is None or not val.is_floating_point():
+        dtype = val.dtype
+    # At most one in every thin draws of a segment is kept
+    size = -(-flush_every//thin)
+    globals()[var] = torch.empty((size,)+tuple(val.shape), dtype=dtype, device=val.device)
+    counts[var] = 0
+
+def record(values: dict):
+    # values: the current draw of every variable; copied, so later updates of the state cannot alias it
+    global count, kept
+    for var, (thin, _) in recorded.items():
+        if kept % thin != 0:
+            continue
+        if not isinstance(globals()[var], torch.Tensor):
+            allocate(var, values[var])
+        globals()[var][counts[var]].copy_(values[var])
+        counts[var] += 1
+    count += 1
+    kept += 1
+
+def buffered():
+    return count
+
+def flush():
+    global segment, count
+    if count == 0:
+        return
+    for var in recorded:
+        if enabled and counts[var] > 0:
+            block = globals()[var][:counts[var]].cpu()
+            for c, chain in enumerate(chain_ids):
+                FileUtils.write_segment(block[:, c], paths[var], chain, segment)
+        counts[var] = 0
+    count = 0
+    segment += 1
+
+def truncate():
+    # Removes the segments written after the current one, e.g. when resuming a run
+    for var in recorded:
+        for chain in chain_ids:
+            FileUtils.remove_segments(paths[var], chain, segment)
+
 def write():
-    for var, path in paths.items():
-        FileUtils.write_to_file(globals()[var], path[0])
+    flush()
+
+def reader(var: str, chain: int = 0):
+    return FileUtils.DrawReader(paths[var], chain)
+
+def read(chain: int = 0):
+    # Replaces every recorded buffer by a lazy, memory-mapped reader
+    for var in recorded:
+        globals()[var] = reader(var, chain)
+
+def chains_reader(var: str, chains: list[int]):
+    return FileUtils.ChainsReader(paths[var], chains)
+
+def read_chains(chains: list[int]):
+    # As read, with the chains merged along a chain axis after the draws
+    for var in recorded:
+        globals()[var] = chains_reader(var, chains)
 
-def read():
-    for var,path in paths.items():
-        globals()[var] = FileUtils.read_from_file(path[0],path[1])
\ No newline at end of file
+def rhat(var: str, n_chains: int):
+    # Cross-chain convergence diagnostic for every element of a recorded variable
+    return ComputingUtils.gelman_rubin(chains_reader(var, list(range(n_chains)))[:])
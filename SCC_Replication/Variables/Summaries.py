@@ -0,0 +1,58 @@
+"""
+Posterior summaries computed online from every kept draw: mean,
+variance and the quantiles in probs of every element, per chain.
+Memory does not grow with the number of draws, so long runs can
+keep these instead of the full Store output
+"""
+
+import os
+import torch
+import Utils.FileUtils as FileUtils
+import Utils.StreamingUtils as StreamingUtils
+
+enabled = False
+out = 'Results/Summaries'
+probs = [0.05, 0.16, 0.5, 0.84, 0.95]
+names = ["F", "X", "S_m", "sigma_m2", "sigma_Da2", "mu_c", "omega2", "f0", "mu_m"]
+
+moments = {}
+quantiles = {}
+
+def reset():
+    for name in names:
+        moments[name] = StreamingUtils.Welford()
+        quantiles[name] = StreamingUtils.P2Quantiles(probs)
+
+def update(values: dict):
+    for name in names:
+        moments[name].update(values[name])
+        quantiles[name].update(values[name])
+
+def results():
+    # Every entry keeps the leading chain dimension of the state
+    return {name: {
+        "count": moments[name].count,
+        "mean": moments[name].mean,
+        "var": moments[name].variance(),
+        "probs": torch.tensor(probs),
+        "quantiles": quantiles[name].quantiles()
+    } for name in names if moments[name].count > 0}
+
+def write(chain_ids: list[int]):
+    summary = results()
+    for c, chain in enumerate(chain_ids):
+        FileUtils.write_torch({name: {key: val[c] if key in ["mean", "var", "quantiles"] else val
+                                      for key, val in entry.items()}
+                               for name, entry in summary.items()},
+                              os.path.join(out, f"chain{chain}.pt"))
+
+def state():
+    # Plain dicts of tensors, so checkpoints load without unpickling classes
+    return {name: (vars(moments[name]), vars(quantiles[name])) for name in moments}
+
+def load_state(saved: dict, device: torch.device):
+    reset()
+    for name, (m, q) in saved.items():
+        for acc, attrs in [(moments[name], m), (quantiles[name], q)]:
+            for key, val in attrs.items():
+                setattr(acc, key, val.to(device) if isinstance(val, torch.Tensor) else val)
@@ -1,49 +1,148 @@
+import argparse
+import os
 import time
 from Prepare import *
 from Steps import *
 from Draw import *
 import Variables.PreComputed as PreComputed
 import Variables.Store as Store
+import Variables.Summaries as Summaries
 import Utils.FileUtils as FileUtils
+import Parallel
+import Forecast
 
 pop_path = 'Data/pop_raw.csv'
 yp_path = 'Data/yp_raw.csv'
 theta_path = 'Results/Thetas/theta.csv'
+checkpoint_dir = 'Results/Checkpoints'
 burn_in = 10
 total_draws = 100
+skips = 1 # Sweeps between kept draws after burn-in
+n_chains = 1
+processes = 1 # Chains run on a process pool when greater than 1
+seed = 0
+checkpoint_every = 50 # Sweeps between checkpoints, 0 disables them
 save=True
+summarize = False # Online means, variances and quantiles, see Variables/Summaries.py
+paths = False # Predictive paths of F and every country, see Forecast.py
+# Recorded variables: name -> (thinning interval, dtype); variables left out are not stored
+record = {
+    "F_draws": (1, torch.float32),
+    "S_m_draws": (1, torch.float32),
+    "X_draws": (1, torch.float32),
+    "C_draws": (1, torch.float32),
+    "sigma_m2_draws": (1, torch.float32),
+    "sigma_Da2_draws": (1, torch.float32),
+    "ind_rho_draws": (1, None),
+    "mu_c_draws": (1, torch.float32),
+    "omega2_draws": (1, torch.float32),
+    "f0_draws": (1, torch.float32),
+    "mu_m_draws": (1, torch.float32),
+    "p_c_kappa_draws": (1, torch.float32),
+    "p_g_kappa_draws": (1, torch.float32),
+    "p_h_kappa_draws": (1, torch.float32),
+    "p_c_theta_draws": (1, torch.float32),
+    "p_g_theta_draws": (1, torch.float32),
+    "p_h_theta_draws": (1, torch.float32),
+    "p_c_lambda_draws": (1, torch.float32),
+    "p_g_lambda_draws": (1, torch.float32),
+    "kappa_c2_draws": (1, torch.float32),
+    "kappa_g2_draws": (1, torch.float32),
+    "kappa_h2_draws": (1, torch.float32),
+    "lambda_c_draws": (1, torch.float32),
+    "lambda_g_draws": (1, torch.float32),
+    "G_draws": (1, torch.float32),
+    "H_draws": (1, torch.float32),
+    "K_draws": (1, None),
+    "J_draws": (1, None),
+    "ind_theta_c_draws": (1, None),
+    "ind_theta_g_draws": (1, None),
+    "ind_theta_h_draws": (1, None)
+}
 
-def main():
-    if save:
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the chains from their last checkpoint')
+    parser.add_argument('--total-draws', type=int, default=total_draws,
+                        help='total number of sweeps, including burn-in')
+    return parser.parse_args()
+
+def report_rhat(n_chains: int):
+    # Read back from the per-chain segments, so both the batched and the pool runs report it
+    for var in ["sigma_m2_draws", "sigma_Da2_draws", "mu_c_draws", "omega2_draws", "F_draws"]:
+        if var in Store.recorded:
+            print(f"R-hat {var}: {torch.max(Store.rhat(var, n_chains)).item()}")
+
+def main(args):
+    # Seeds the default chain seeds; the theta grid has its own PreComputed.theta_seed
+    torch.manual_seed(seed)
+    Store.enabled = save
+    Store.recorded = record
+    Summaries.enabled = summarize
+    Forecast.enabled = paths
+    if save and not args.resume:
         Store.clear_files()
     start = time.time()
     # Prepare data
     theta, R = precompute(pop_path, yp_path)
     end = time.time()
     print(f"Preparations: {end-start}")
-    FileUtils.write_mat(theta, theta_path)
+    if not args.resume:
+        FileUtils.write_mat(theta, theta_path)
+    if processes > 1:
+        start = time.time()
+        times = Parallel.run_chains(n_chains, processes, burn_in, args.total_draws, seed,
+                                    skips=skips,
+                                    checkpoint_dir=checkpoint_dir,
+                                    checkpoint_every=checkpoint_every,
+                                    resume=args.resume)
+        end = time.time()
+        print(f"Parallel Gibbs Draws: {end-start} (per chain: {times})")
+        if save and n_chains > 1:
+            report_rhat(n_chains)
+        return
+
+    checkpoint_path = os.path.join(checkpoint_dir, 'chains.pt')
     start = time.time()
-    # Initialize Gibbs state
-    initialize(
-        PreComputed.regions, 
-        PreComputed.no_kappas, 
-        PreComputed.no_lambdas, 
-        PreComputed.no_thetas
-    )
+    if args.resume:
+        sweep, Delta = load_checkpoint(checkpoint_path)
+    else:
+        # Initialize Gibbs state
+        initialize(
+            PreComputed.regions, 
+            PreComputed.no_kappas, 
+            PreComputed.no_lambdas, 
+            PreComputed.no_thetas,
+            n_chains
+        )
+        Store.reset(list(range(n_chains)))
+        sweep, Delta = 0, None
     end = time.time()
     print(f"Initialization: {end-start}")
 
+    if paths:
+        Forecast.open_arrays(Forecast.no_kept(burn_in, args.total_draws, skips), Store.chain_ids, args.resume)
+
     start = time.time()
-    sample(burn_in, total_draws)
+    sample(burn_in, args.total_draws, skips, start=sweep, Delta=Delta,
+           checkpoint_path=checkpoint_path, checkpoint_every=checkpoint_every)
+    Forecast.flush()
 
     end = time.time()
     print(f"Gibbs Draws: {end-start}")
 
+    if summarize:
+        Summaries.write(Store.chain_ids)
+
     if save:
         start = time.time()
         Store.write()
         end = time.time()
         print(f"Saving: {end-start}")
 
+        if State.n_chains > 1:
+            report_rhat(State.n_chains)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main(parse_args())
@@ -167,12 +167,12 @@ def load_forecast(
 
     return in_sample, test_preds, horizon_preds
 
-def load_baseline_data() -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+def load_baseline_data(paths_dir: str = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """
     Loads baseline econometric models results for comparison
 
     Parameters:
-        n (int): The number of countries in the experiment
+        paths_dir (str): A directory with the path_F_draws.npy and paths_U_draws.npy arrays written by the sampler; the mcmc .mat files are used if not given
 
     Returns:
         np.ndarray: The low frequency in-sample data
@@ -183,9 +183,13 @@ def load_baseline_data() -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray
         np.ndarray: The median of the baseline predictions
         np.ndarray: The mean of the baseline predictions 
     """
-    paths_F = np.array(loadmat("mcmc/path_F_draws_baseline.mat")['path_F_draws'])
-    paths_U = np.array(loadmat("mcmc/paths_U_draws_baseline.mat")['paths_U_draws'])
-    draws = np.zeros((218,Constants.n,3000))
+    if paths_dir is None:
+        paths_F = np.array(loadmat("mcmc/path_F_draws_baseline.mat")['path_F_draws'])
+        paths_U = np.array(loadmat("mcmc/paths_U_draws_baseline.mat")['paths_U_draws'])
+    else:
+        paths_F = np.load(f"{paths_dir}/path_F_draws.npy", mmap_mode='r')
+        paths_U = np.load(f"{paths_dir}/paths_U_draws.npy", mmap_mode='r')
+    draws = np.zeros((218,Constants.n,paths_F.shape[-1]))
     for i in range(Constants.n):
         draws[:, i, :] = paths_F+paths_U[:, i, :]
     low_frequency = draws[60:118,:,0]